@@ -0,0 +1,221 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import unquote
+
+from bottle import ServerAdapter
+
+
+# Bigger request heads than this get a 431
+MAX_HEAD = 64 * 1024
+# Bodies are read whole into memory; bigger ones get a 413
+MAX_BODY = 16 * 1024 * 1024
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE = 75
+# Streamed responses are written in pieces of about this size
+CHUNK = 64 * 1024
+# Long-lived responses (see `streams`) served at once
+MAX_STREAMS = 1024
+
+
+class _Response:
+
+    def __init__(self):
+        self.status = None
+        self.headers = []
+
+    def start(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = headers
+        return lambda data: None
+
+
+def _call(app, environ, response, chunk):
+    """Runs the WSGI app, on an executor thread."""
+    chunks = app(environ, response.start)
+    if isinstance(chunks, list):
+        return chunks, None
+    return _pull(chunks, chunk), chunks
+
+
+def _pull(chunks, chunk):
+    """The next `chunk` or so bytes of a streamed response, none at the end."""
+    pieces, size = [], 0
+    for piece in chunks:
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk:
+            break
+    return pieces
+
+
+def _close(chunks):
+    if hasattr(chunks, 'close'):
+        chunks.close()
+
+
+class AsyncioServer(ServerAdapter):
+    """
+    An HTTP/1.1 server on asyncio, running the WSGI app on small thread
+    pools: one for GET and HEAD, one for everything else, so reads keep
+    flowing while writes wait on the database. Idle keep-alive
+    connections cost a coroutine, not a thread. Requests for one of the
+    `streams` paths (long-lived responses, which block while waiting
+    for what to send next) run on a third pool, up to MAX_STREAMS.
+    """
+
+    def run(self, app):
+        threads = self.options.get('threads', 8)
+        self.streams = set(self.options.get('streams', ()))
+        self.app = app
+        self.readers = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='read')
+        self.writers = ThreadPoolExecutor(max_workers=max(2, threads // 2), thread_name_prefix='write')
+        self.streamers = ThreadPoolExecutor(max_workers=MAX_STREAMS, thread_name_prefix='stream')
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.readers.shutdown(wait=False)
+            self.writers.shutdown(wait=False)
+            self.streamers.shutdown(wait=False)
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._connection, self.host, self.port,
+                                            limit=MAX_HEAD, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    async def _connection(self, reader, writer):
+        try:
+            while await self._request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _request(self, reader, writer):
+        """Handles one request, returns whether to keep the connection."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE)
+        except asyncio.LimitOverrunError:
+            await self._error(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            return False
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self._error(writer, HTTPStatus.BAD_REQUEST)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                name = name.strip().lower()
+                value = value.strip()
+                headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            await self._error(writer, HTTPStatus.LENGTH_REQUIRED)
+            return False
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            await self._error(writer, HTTPStatus.BAD_REQUEST)
+            return False
+        if length > MAX_BODY:
+            await self._error(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return False
+        if length and headers.get('expect', '').lower() == '100-continue' and version == 'HTTP/1.1':
+            # Or the client waits a while before sending the body
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        body = await reader.readexactly(length)
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        environ = self._environ(method, target, version, headers, body, writer)
+        chunk = CHUNK
+        if method not in ('GET', 'HEAD'):
+            executor = self.writers
+        elif environ['PATH_INFO'] in self.streams:
+            # Whatever they have is sent right away
+            executor, chunk = self.streamers, 1
+        else:
+            executor = self.readers
+        loop = asyncio.get_running_loop()
+        response = _Response()
+        pieces, stream = await loop.run_in_executor(executor, _call, self.app, environ, response, chunk)
+        try:
+            return await self._respond(writer, executor, response, pieces, stream, chunk,
+                                       version, keep_alive, method == 'HEAD')
+        finally:
+            if stream is not None:
+                await loop.run_in_executor(executor, _close, stream)
+
+    def _environ(self, method, target, version, headers, body, writer):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': (writer.get_extra_info('peername') or ('',))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        return environ
+
+    async def _respond(self, writer, executor, response, pieces, stream, chunk, version, keep_alive, head):
+        headers = response.headers
+        names = {name.lower() for name, _ in headers}
+        chunked = False
+        if 'content-length' not in names:
+            if stream is None:
+                headers.append(('Content-Length', str(sum(map(len, pieces)))))
+            elif version == 'HTTP/1.1':
+                headers.append(('Transfer-Encoding', 'chunked'))
+                chunked = True
+            else:
+                keep_alive = False
+        headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        writer.write(f"{version} {response.status}\r\n".encode('latin-1')
+                     + "".join(f"{name}: {value}\r\n" for name, value in headers).encode('latin-1')
+                     + b"\r\n")
+        loop = asyncio.get_running_loop()
+        while pieces:
+            data = b"".join(pieces)
+            if not head and data:
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+            await writer.drain()
+            if stream is None:
+                break
+            pieces = await loop.run_in_executor(executor, _pull, stream, chunk)
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return keep_alive
+
+    async def _error(self, writer, status):
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                     f"Content-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
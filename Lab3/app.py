@@ -1,14 +1,74 @@
 
-from bottle import get, post, run, request, response
+from bottle import Bottle, HTTPResponse, JSONPlugin, request, response
+import json
+import os
 import sqlite3
+import uuid
 from urllib.parse import unquote
 
-PORT = 7007
-
-
-db = sqlite3.connect('movies.sqlite')
-
-@get('/ping')
+from auth import CredentialCache, hash_password, hash_passwords, needs_rehash, verify_password
+from cache import CachePlugin, ResponseCache, SharedVersions
+from compression import CompressionPlugin, Compressor
+from database import ConnectionPool, PoolPlugin, Snapshots, check_query_plans, init_db
+from events import ChangeFeed
+from groupcommit import GroupCommitQueue
+from inventory import SeatInventory
+from listing import listing, page_params, sql_limit
+from metrics import InstrumentedConnection, Metrics, MetricsPlugin
+from replica import Replica
+import serializer
+from servers import is_worker, serve
+
+PORT = int(os.environ.get('LAB3_PORT', 7007))
+
+DB_PATH = os.environ.get('LAB3_DB', 'movies.sqlite')
+SERVER = os.environ.get('LAB3_SERVER', 'threadpool')
+THREADS = int(os.environ.get('LAB3_THREADS', os.cpu_count() or 4))
+POOL_SIZE = int(os.environ.get('LAB3_POOL_SIZE', THREADS))
+STATEMENT_CACHE = int(os.environ.get('LAB3_STATEMENT_CACHE', 128))
+CACHE_SIZE = int(os.environ.get('LAB3_CACHE_SIZE', 256))
+METRICS = os.environ.get('LAB3_METRICS', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('LAB3_SLOW_QUERY_MS', 100))
+AUTH_CACHE_SIZE = int(os.environ.get('LAB3_AUTH_CACHE_SIZE', 1024))
+AUTH_CACHE_TTL = float(os.environ.get('LAB3_AUTH_CACHE_TTL', 300))
+GROUP_COMMIT = os.environ.get('LAB3_GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_BATCH = int(os.environ.get('LAB3_GROUP_COMMIT_BATCH', 64))
+GROUP_COMMIT_WAIT_MS = float(os.environ.get('LAB3_GROUP_COMMIT_WAIT_MS', 0))
+INVENTORY = os.environ.get('LAB3_INVENTORY', '0') == '1'
+JSON_ENCODER = os.environ.get('LAB3_JSON', 'auto')
+COMPRESSION = os.environ.get('LAB3_COMPRESSION', '1') == '1'
+COMPRESS_MIN_SIZE = int(os.environ.get('LAB3_COMPRESS_MIN_SIZE', 1024))
+WORKERS = int(os.environ.get('LAB3_WORKERS', 1))
+STREAM_INTERVAL_MS = float(os.environ.get('LAB3_STREAM_INTERVAL_MS', 500))
+# 'commit' (copied as soon as something's written), 'timer' (copied
+# every LAB3_REPLICA_INTERVAL_MS if something was) or 'off'
+REPLICA = os.environ.get('LAB3_REPLICA', 'off')
+REPLICA_INTERVAL_MS = float(os.environ.get('LAB3_REPLICA_INTERVAL_MS', 250))
+# How far behind the database each browse route may read, 0 for only
+# while the replica is up to date
+REPLICA_BUDGETS_MS = {
+    'movies': float(os.environ.get('LAB3_REPLICA_MOVIES_MS', 0)),
+    'performances': float(os.environ.get('LAB3_REPLICA_PERFORMANCES_MS', 0)),
+    'tickets': float(os.environ.get('LAB3_REPLICA_TICKETS_MS', 0)),
+}
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'movies.sql')
+SEEDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seeds')
+
+
+app = Bottle()
+snapshots = Snapshots(SCHEMA, SEEDS)
+
+# Set up by create_app()
+pool = None
+cache = None
+metrics = None
+credentials = None
+inventory = None
+purchases = None
+performance_feed = None
+replica = None
+
+@app.get('/ping')
 def get_ping():
     string = "pong"
    
@@ -16,38 +76,43 @@ def get_ping():
     found = [{"string": string}]
     return {string}
 
-@post('/reset')
+@app.post('/reset', invalidates=('customers', 'movies', 'performances'))
 def reset():
-    c = db.cursor()
-    #c.execute("PRAGMA foreign_keys=ON;")
-    tables = ["theaters", "movies", "screenings", "tickets", "customers"]
-    for table in tables:
-        c.execute(
-           f"""
-           DELETE
-           FROM {table}
-            """)
-
-    c.execute(
-        """
-        INSERT
-         INTO theaters(theater_name, capacity)
-          VALUES ('Kino', 10),
-                ('Regal', 16),
-                ('Skandia', 100)
-          """
-    )
-    db.commit()
+    seed = request.query.seed or 'default'
+    if inventory is not None:
+        inventory.flush()
+    with pool.writer() as db:
+        try:
+            snapshots.restore(seed, db)
+        except KeyError:
+            response.status = 404
+            return f"No seed named {seed}, try one of {', '.join(snapshots.names)}"
+    if inventory is not None:
+        inventory.load()
+    credentials.clear()
+    performance_feed.resync()
     response.status = 200
     return "yihaa"
 
 
-@post('/users')
+# The routes hashing or checking passwords check out their own
+# connections, so the (deliberately slow) KDF never runs while
+# holding the writer
+
+@app.post('/users')
 def post_users():
     user = request.json
     username = user['username']
     full_name = user['fullName']
-    pwd = user['pwd']
+    if not isinstance(user['pwd'], str):
+        response.status = 400
+        return "pwd must be a string"
+    pwd = hash_password(user['pwd'])
+    with pool.writer() as db:
+        return insert_user(db, username, full_name, pwd)
+
+
+def insert_user(db, username, full_name, pwd):
     c = db.cursor()
     try: 
         c.execute(
@@ -69,11 +134,12 @@ def post_users():
             username, = found
             return f"/users/{username}"
     except sqlite3.IntegrityError:
+        db.rollback()
         response.status = 400
         return "fanns redan"
 
-@post('/movies')
-def post_movies():
+@app.post('/movies', invalidates=('movies',))
+def post_movies(db):
     movie = request.json
     imdb_key = movie['imdbKey']
     title = movie['title']
@@ -99,11 +165,12 @@ def post_movies():
             imdbkey, = found
             return f"/movies/{imdbkey}"
     except sqlite3.IntegrityError:
+        db.rollback()
         response.status = 400
         return ""
 
-@post('/performances')
-def post_performances():
+@app.post('/performances', invalidates=('performances',))
+def post_performances(db):
     performance = request.json
     imdb_key = performance['imdbKey']
     theater = performance['theater']
@@ -119,7 +186,6 @@ def post_performances():
             """,
             [theater])
         capacity, = c.fetchone()
-        print(capacity)
 
         c.execute(
             """
@@ -138,173 +204,565 @@ def post_performances():
             db.commit()
             response.status = 201
             screening_id, = found
+            if inventory is not None:
+                inventory.add(screening_id, capacity)
+            performance_feed.publish(screening_id)
             return f"/performances/{screening_id}"
     except sqlite3.IntegrityError:
+        db.rollback()
         response.status = 400
         return "No such movie or theater"
 
-@get('/movies')
-def get_movies():
+def batch_rows(fields):
+    """
+    Reads a JSON array of objects from the request body, and returns one
+    tuple of the values of `fields` (a dict of name to type) per object,
+    or None for objects missing any of them or holding the wrong type.
+    """
+    items = request.json
+    if not isinstance(items, list):
+        raise HTTPResponse("Expected a JSON array", status=400)
+    rows = []
+    for item in items:
+        try:
+            row = tuple(item[field] for field in fields)
+        except (KeyError, TypeError):
+            rows.append(None)
+            continue
+        # JSON true and false are ints to Python
+        valid = all(isinstance(value, kind) and not isinstance(value, bool)
+                    for value, kind in zip(row, fields.values()))
+        rows.append(row if valid else None)
+    return rows
+
+
+def existing_keys(c, table, column, keys):
+    c.execute(
+        f"""
+        SELECT {column}
+        FROM {table}
+        WHERE {column} IN (SELECT value FROM json_each(?))
+        """,
+        [json.dumps(keys)]
+    )
+    return {key for key, in c}
+
+
+def insert_batch(db, rows, key_of, existing, location_of, insert, key_name):
+    """
+    Sorts `rows` into created / conflict / invalid, and inserts the new
+    ones with a single executemany in the caller's transaction.
+    """
+    results = []
+    new = []
+    seen = set(existing)
+    for row in rows:
+        if row is None or not isinstance(key_of(row), str):
+            results.append({"status": "invalid"})
+        elif key_of(row) in seen:
+            results.append({"status": "conflict", key_name: key_of(row)})
+        else:
+            seen.add(key_of(row))
+            new.append(row)
+            results.append({"status": "created", "location": location_of(row)})
+    db.executemany(insert, new)
+    db.commit()
+    return {"data": results}
+
+
+@app.post('/users/batch')
+def post_users_batch():
+    rows = batch_rows({'username': str, 'fullName': str, 'pwd': str})
+    # Hashing takes ~60 ms a password, so only hash those of users that
+    # aren't there already (nor earlier in the batch), before taking
+    # the writer
+    with pool.reader() as db:
+        existing = existing_keys(db.cursor(), "customers", "user_name", [row[0] for row in rows if row])
+    new = {}
+    for i, row in enumerate(rows):
+        if row and row[0] not in existing:
+            existing.add(row[0])
+            new[i] = row[2]
+    hashed = dict(zip(new, hash_passwords(new.values())))
+    with pool.writer() as db:
+        c = db.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        existing = existing_keys(c, "customers", "user_name", [row[0] for row in rows if row])
+        claimed = set(existing)
+        for i, row in enumerate(rows):
+            if row is None:
+                continue
+            username, full_name, pwd = row
+            if username in claimed:
+                # A conflict, which insert_batch won't write
+                rows[i] = (username, full_name, None)
+            else:
+                claimed.add(username)
+                # Unless it was gone after we looked (e.g. a reset)
+                rows[i] = (username, full_name, hashed[i] if i in hashed else hash_password(pwd))
+        return insert_batch(db, rows, lambda row: row[0], existing,
+                        lambda row: f"/users/{row[0]}",
+                        """
+                        INSERT
+                        INTO  customers(user_name, full_name, password)
+                        VALUES (?,?,?)
+                        """,
+                        "username")
+
+
+@app.post('/movies/batch', invalidates=('movies',))
+def post_movies_batch(db):
+    rows = batch_rows({'imdbKey': str, 'title': str, 'year': int})
+    c = db.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    existing = existing_keys(c, "movies", "imdb_key", [row[0] for row in rows if row])
+    return insert_batch(db, rows, lambda row: row[0], existing,
+                        lambda row: f"/movies/{row[0]}",
+                        """
+                        INSERT
+                        INTO  movies(imdb_key, movie_title, production_year)
+                        VALUES (?,?,?)
+                        """,
+                        "imdbKey")
+
+
+@app.post('/performances/batch', invalidates=('performances',))
+def post_performances_batch(db):
+    rows = batch_rows({'imdbKey': str, 'theater': str, 'date': str, 'time': str})
     c = db.cursor()
+    c.execute("BEGIN IMMEDIATE")
     c.execute(
         """
+        SELECT theater_name, capacity
+        FROM theaters
+        """)
+    capacities = dict(c.fetchall())
+    movies = existing_keys(c, "movies", "imdb_key", [row[0] for row in rows if row])
+    # Performances have no natural key, so they never conflict; we make
+    # up their ids here (the same kind of id the column default makes)
+    # since executemany can't return them
+    performances = []
+    for row in rows:
+        if row is None or row[0] not in movies or row[1] not in capacities:
+            performances.append(None)
+        else:
+            imdb_key, theater, date, time = row
+            performances.append((uuid.uuid4().hex, time, date, theater, imdb_key, capacities[theater]))
+    found = insert_batch(db, performances, lambda row: row[0], (),
+                         lambda row: f"/performances/{row[0]}",
+                         """
+                         INSERT
+                         INTO  screenings(screening_id, start_time, start_date, theater_name, imdb_key, remaining_seats)
+                         VALUES (?,?,?,?,?,?)
+                         """,
+                         "performanceId")
+    # Only once they're committed, so no seat is sold on a screening
+    # that never made it to disk
+    for performance in performances:
+        if performance is not None:
+            if inventory is not None:
+                inventory.add(performance[0], performance[-1])
+            performance_feed.publish(performance[0])
+    return found
+
+
+def movie_row(cursor, row):
+    imdb_key, title, year = row
+    return {"imdbKey": imdb_key,
+            "title": title,
+            "year": year}
+
+# Search conditions on movies, in the order they're put in the query
+MOVIE_FILTERS = {
+    'title': "movie_title = ? COLLATE NOCASE",
+    'titlePrefix': "movie_title >= ? COLLATE NOCASE AND movie_title < ? COLLATE NOCASE",
+    'year': "production_year = ?",
+}
+
+def movies_query(filters=()):
+    conditions = [MOVIE_FILTERS[name] for name in MOVIE_FILTERS if name in filters]
+    conditions.append("imdb_key > ?")
+    return f"""
         SELECT imdb_key, movie_title, production_year 
         FROM movies
+        WHERE {" AND ".join(conditions)}
+        ORDER BY imdb_key
+        LIMIT ?
         """
-    )
-    found = [{"imdbKey":imdb_key,
-                "title": title,
-                "year": year} for imdb_key, title, year in c ]
-    return {"data": found}
 
-@get('/movies/<imdbKey>')
-def get_movies(imdbKey):
+MOVIES_QUERY = movies_query()
+
+@app.get('/movies', cache=('movies',), replica='movies')
+def get_movies(db):
+    filters = [name for name in MOVIE_FILTERS if name in request.query]
+    params = []
+    if 'title' in filters:
+        params.append(request.query.title)
+    if 'titlePrefix' in filters:
+        # Everything sorting between the prefix and the prefix followed
+        # by the largest code point, so the title index can be used
+        prefix = request.query.titlePrefix
+        params += [prefix, prefix + '\U0010ffff']
+    if 'year' in filters:
+        try:
+            params.append(int(request.query.year))
+        except ValueError:
+            response.status = 400
+            return "year must be an integer"
+    limit, after = page_params()
     c = db.cursor()
-    c.execute(
-        """
+    c.row_factory = movie_row
+    c.execute(movies_query(filters), params + [after or '', sql_limit(limit)])
+    return listing(c, limit, key=lambda movie: movie["imdbKey"])
+
+MOVIE_QUERY = """
         SELECT imdb_key, movie_title, production_year 
         FROM movies
         WHERE imdb_key = ?
-        """,
-        [imdbKey]
-    )
-    found = [{"imdbKey":imdb_key,
-                "title": title,
-                "year": year} for imdb_key, title, year in c ]
-    return {"data": found}
+        """
 
-@get('/performances')
-def get_performances():
+@app.get('/movies/<imdbKey>', cache=('movies',), replica='movies')
+def get_movies(imdbKey, db):
     c = db.cursor()
-    c.execute(
+    c.row_factory = movie_row
+    c.execute(MOVIE_QUERY, [imdbKey])
+    return {"data": c.fetchall()}
+
+def performance_row(cursor, row):
+    performance_id, date, start_time, title, year, theater, remaining_seats = row
+    return {"performanceId": performance_id,
+            "date": date,
+            "startTime": start_time,
+            "title": title,
+            "year": year,
+            "theater": theater,
+            "remainingSeats": remaining_seats}
+
+def live_performance_row(cursor, row):
+    # The database lags behind the inventory by the unwritten sales
+    performance = performance_row(cursor, row)
+    performance["remainingSeats"] = inventory.remaining(performance["performanceId"])
+    return performance
+
+PERFORMANCES_QUERY = """
+        SELECT screening_id, start_date, start_time, movie_title, production_year, theater_name, remaining_seats
+        FROM screenings
+        JOIN movies USING (imdb_key)
+        WHERE screening_id > ?
+        ORDER BY screening_id
+        LIMIT ?
         """
-        SELECT *
+
+@app.get('/performances', cache=('performances',), replica='performances')
+def get_performances(db):
+    limit, after = page_params()
+    c = db.cursor()
+    c.row_factory = performance_row if inventory is None else live_performance_row
+    c.execute(PERFORMANCES_QUERY, [after or '', sql_limit(limit)])
+    return listing(c, limit, key=lambda performance: performance["performanceId"])
+
+PERFORMANCE_CHANGES_QUERY = """
+        SELECT screening_id, start_date, start_time, movie_title, production_year, theater_name, remaining_seats
         FROM screenings
         JOIN movies USING (imdb_key)
+        WHERE screening_id IN (SELECT value FROM json_each(?))
+        ORDER BY screening_id
         """
-    )
-    found = [{"performanceId": performance_id,
-                "date": date,
-                "startTime": start_time,
-                "title": title,
-                "year": year,
-                "theater": theater,
-                "remainingSeats": remaining_seats} for performance_id, start_time, date, theater,
-                  _, remaining_seats, title, year, _  in c ]
-    return {"data": found}
-
-
-@post('/tickets')
+
+def all_performances():
+    with pool.reader() as db:
+        c = db.cursor()
+        c.row_factory = performance_row if inventory is None else live_performance_row
+        c.execute(PERFORMANCES_QUERY, ['', -1])
+        return c.fetchall()
+
+def changed_performances(screening_ids):
+    with pool.reader() as db:
+        c = db.cursor()
+        c.row_factory = performance_row if inventory is None else live_performance_row
+        c.execute(PERFORMANCE_CHANGES_QUERY, [json.dumps(screening_ids)])
+        return c.fetchall()
+
+@app.get('/performances/stream')
+def stream_performances():
+    return performance_feed.stream()
+
+
+PASSWORD_QUERY = """
+              SELECT password
+              FROM customers
+              WHERE  user_name = ?
+              """
+
+def authenticate(user_name, password):
+    if not isinstance(password, str):
+        return False
+    if credentials.check(user_name, password):
+        return True
+    with pool.reader() as db:
+        c = db.cursor()
+        c.execute(PASSWORD_QUERY, [user_name])
+        found = c.fetchone()
+    stored = found[0] if found else None
+    if not verify_password(password, stored):
+        return False
+    if needs_rehash(stored):
+        rehashed = hash_password(password)
+        with pool.writer() as db:
+            db.execute(
+                """
+                UPDATE customers
+                SET password = ?
+                WHERE user_name = ? AND password = ?
+                """,
+                [rehashed, user_name, stored])
+            db.commit()
+    credentials.add(user_name, password)
+    return True
+
+RESERVE_SEAT_QUERY = """
+                UPDATE screenings
+                SET remaining_seats = remaining_seats - 1
+                WHERE screening_id = ? AND remaining_seats > 0
+                RETURNING remaining_seats
+                  """
+
+@app.post('/tickets', invalidates=('performances',))
 def post_tickets():
     ticket = request.json
     user_name = ticket['username']
     password = ticket['pwd']
     screening_id =ticket['performanceId']
-    c = db.cursor()
-
 
     ### Kolla om user och password is wrong  
 
-    c.execute("""
-              SELECT user_name, password
-              FROM customers
-              WHERE  user_name = ?  AND password = ?
-              """
-              ,[user_name, password])
-    found = c.fetchone()
-    if not found:
+    if not authenticate(user_name, password):
         response.status = 401
         return "Wrong user Credentials"
 
-    c.execute(
-        """
-        SELECT count()
-        FROM tickets
-        GROUP BY screening_id
-        HAVING screening_id = ?
-        """,[screening_id]
-    )
-    found = c.fetchone()
-
-    if not found:
-        nbrtickets = 0
+    if inventory is not None:
+        status, body = sell_from_inventory(user_name, screening_id)
+    elif purchases is not None:
+        status, body = purchases.submit(user_name, screening_id)
     else:
-        nbrtickets, = found
-    print(nbrtickets)
-    
-    c.execute(
-        """
-    SELECT capacity
-    FROM theaters
-    WHERE theater_name IN (
-        SELECT theater_name 
-        FROM screenings
-        WHERE screening_id = ?
-    ) 
-    """, [screening_id]
-    )
+        with pool.writer() as db:
+            status, body = reserve_ticket(db, user_name, screening_id)
+    if status == 201:
+        performance_feed.publish(screening_id)
+    response.status = status
+    return body
+
+
+def reserve_ticket(db, user_name, screening_id):
+    # Take the seat and create the ticket in one short write transaction.
+    # BEGIN IMMEDIATE grabs the write lock up front, and the guarded
+    # UPDATE only touches the target screening, so two buyers can never
+    # get the same last seat.
+    c = db.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        found = sell_ticket(c, user_name, screening_id)
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return found
+
+
+def sell_ticket(c, user_name, screening_id):
+    """
+    Sells one ticket inside the caller's write transaction, and returns
+    the response status and body. Nothing is changed when there's no seat.
+    """
+    c.execute(RESERVE_SEAT_QUERY, [screening_id])
     found = c.fetchone()
-    capacity, = found
-    print(capacity)
-    if capacity - nbrtickets > 0:
-        c.execute("""
-                INSERT
-                  INTO tickets(user_name, screening_id)
-                  VALUES (?, ?)
-                  RETURNING ticket_id
-                  """,[user_name, screening_id])
-        found = c.fetchone()
-        ticket_id, = found
-
-
+    if not found:
         c.execute("""
-                UPDATE screenings
-                SET remaining_seats = remaining_seats -1
-                RETURNING remaining_seats
-                  """)
-        found = c.fetchone()
-        remaining_seats, = found
-        print(f"remaining seats = {remaining_seats}")
-        response.status = 201
-        return f"/tickets/{ticket_id}"
-     
-    elif capacity - nbrtickets == 0:
-        response.status = 400
-        return "No tickets left"
-
-    else:
-        response.status = 400
-        return "error" 
-
+                SELECT screening_id
+                FROM screenings
+                WHERE screening_id = ?
+                  """, [screening_id])
+        missing = c.fetchone() is None
+        return 400, "No such performance" if missing else "No tickets left"
 
-@get('/users/<username>/tickets')
-def get_tickets(username):
-    c = db.cursor()
     c.execute("""
-              WITH nbrtickets AS (SELECT *
-              FROM customers
-              JOIN tickets USING (user_name)
-              WHERE user_name = ?)
-              ,
-
-            movie_info AS (SELECT * 
-              FROM screenings
-              JOIN movies USING (imdb_key))
-
-            SELECT start_date, start_time, theater_name, movie_title, production_year, count() as numberOftickets
-            FROM movie_info 
-            JOIN nbrtickets USING (screening_id)
-            GROUP BY screening_id
-              """,[username])
-    
-    found = [{"date": date, "startTime": starttime, "theater": theater_name, "title": title,
-              "year": year, "nbrOfTickets": nbroftickets}
-              for date, starttime, theater_name, title, year, nbroftickets in c ]
-    return {"data": found}
-
-
-
-
-
+            INSERT
+              INTO tickets(user_name, screening_id)
+              VALUES (?, ?)
+              RETURNING ticket_id
+              """,[user_name, screening_id])
+    ticket_id, = c.fetchone()
+    return 201, f"/tickets/{ticket_id}"
+
+
+def sell_from_inventory(user_name, screening_id):
+    taken = inventory.take(screening_id)
+    if taken is None:
+        return 400, "No such performance"
+    if not taken:
+        return 400, "No tickets left"
+    ticket_id = uuid.uuid4().hex
+    inventory.write_behind(ticket_id, user_name, screening_id)
+    return 201, f"/tickets/{ticket_id}"
+
+
+def ticket_summary_item(row):
+    date, starttime, theater_name, title, year, nbroftickets, _ = row
+    return {"date": date, "startTime": starttime, "theater": theater_name, "title": title,
+            "year": year, "nbrOfTickets": nbroftickets}
+
+USER_TICKETS_QUERY = """
+            SELECT start_date, start_time, theater_name, movie_title, production_year, nbr_of_tickets, screening_id
+            FROM user_tickets
+            JOIN screenings USING (screening_id)
+            JOIN movies USING (imdb_key)
+            WHERE user_name = ? AND screening_id > ?
+            ORDER BY screening_id
+            LIMIT ?
+              """
 
-run(host='127.0.0.1', port=PORT)
+@app.get('/users/<username>/tickets', replica='tickets')
+def get_tickets(username, db):
+    if inventory is not None:
+        inventory.flush()
+    limit, after = page_params()
+    c = db.cursor()
+    c.execute(USER_TICKETS_QUERY, [username, after or '', sql_limit(limit)])
+    # The page key, screening_id, isn't part of the summary
+    return listing(c, limit, key=lambda row: row[-1], to_item=ticket_summary_item)
+
+
+@app.get('/cache')
+def get_cache_stats():
+    return cache.stats()
+
+
+@app.get('/metrics')
+def get_metrics():
+    found = metrics.to_dict()
+    if purchases is not None:
+        found["groupCommit"] = purchases.stats()
+    found["performanceStream"] = performance_feed.stats()
+    if replica is not None:
+        found["replica"] = replica.stats()
+    return found
+
+
+# The queries behind the routes, and the tables each may read in full
+# (the list routes return every row anyway). Anything else falling back
+# to a full scan stops the server at startup.
+ROUTE_QUERIES = {
+    'GET /movies': (MOVIES_QUERY, {'movies'}),
+    'GET /movies?title': (movies_query(['title']), set()),
+    'GET /movies?titlePrefix': (movies_query(['titlePrefix']), set()),
+    'GET /movies?year': (movies_query(['year']), set()),
+    'GET /movies?title&year': (movies_query(['title', 'year']), set()),
+    'GET /movies/<imdbKey>': (MOVIE_QUERY, set()),
+    'GET /performances': (PERFORMANCES_QUERY, {'screenings'}),
+    'GET /performances/stream (changes)': (PERFORMANCE_CHANGES_QUERY, set()),
+    'POST /tickets (credentials)': (PASSWORD_QUERY, set()),
+    'POST /tickets (reserve)': (RESERVE_SEAT_QUERY, set()),
+    'GET /users/<username>/tickets': (USER_TICKETS_QUERY, set()),
+}
+
+
+# The cache tags prefork workers share versions of
+SHARED_TAGS = ('customers', 'movies', 'performances')
+
+
+def check_settings():
+    if INVENTORY and WORKERS > 1:
+        raise SystemExit("LAB3_INVENTORY keeps the seats in one process's memory, "
+                         "it would oversell with LAB3_WORKERS > 1")
+    if REPLICA not in ('off', 'commit', 'timer'):
+        raise SystemExit(f"LAB3_REPLICA is 'off', 'commit' or 'timer', not {REPLICA!r}")
+
+
+def create_app(db_path=DB_PATH):
+    """
+    Sets up the app for the database at `db_path` (creating its schema
+    if need be, and checking the query plans) and returns it, ready to
+    be served or called as a WSGI app. Nothing else happens at import,
+    and connections are only opened once requests need them. Calling it
+    again starts over, e.g. with another database.
+    """
+    global pool, cache, metrics, credentials, inventory, purchases, performance_feed, replica
+    check_settings()
+
+    init_db(db_path, SCHEMA)
+    check_query_plans(db_path, ROUTE_QUERIES)
+    # Stop what the last call started, before its pool goes
+    for old in (performance_feed, purchases, inventory, replica, pool):
+        if old is not None:
+            old.close()
+    pool = ConnectionPool(db_path, size=POOL_SIZE, cached_statements=STATEMENT_CACHE,
+                          factory=InstrumentedConnection if METRICS else sqlite3.Connection)
+    # Prefork workers see each other's writes through shared cache versions
+    versions = None
+    if WORKERS > 1:
+        versions = SharedVersions(db_path + '-versions', SHARED_TAGS, fresh=not is_worker())
+    cache = ResponseCache(maxsize=CACHE_SIZE, versions=versions)
+    metrics = Metrics(slow_ms=SLOW_QUERY_MS)
+    compressor = Compressor(min_size=COMPRESS_MIN_SIZE) if COMPRESSION else None
+
+    # With LAB3_REPLICA, the browse routes read from an in-memory copy
+    # of the database while it lags no more than their budget. Not the
+    # tickets route with the inventory: that writes the tickets sold
+    # behind first, which the copy it was handed can't have
+    replica = None
+    if REPLICA != 'off':
+        budgets = {name: ms / 1000 for name, ms in REPLICA_BUDGETS_MS.items()}
+        if INVENTORY:
+            del budgets['tickets']
+        replica = Replica(pool, budgets, interval=REPLICA_INTERVAL_MS / 1000,
+                          on_write=REPLICA == 'commit',
+                          watch=(lambda: cache.version(('customers', 'movies', 'performances')))
+                                if WORKERS > 1 else None)
+    # The first plugin installed is the outermost one
+    app.uninstall(True)
+    if METRICS:
+        app.install(MetricsPlugin(metrics))
+    if compressor is not None:
+        app.install(CompressionPlugin(compressor))
+    app.install(JSONPlugin(serializer.use(JSON_ENCODER)))
+    app.install(CachePlugin(cache, compressor))
+    app.install(PoolPlugin(pool, replica=replica))
+    credentials = CredentialCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL,
+                                  generation=lambda: cache.version({'customers'}))
+
+    # With LAB3_INVENTORY=1, seats are taken from the in-memory inventory
+    # and tickets written behind (this takes precedence over group commit)
+    inventory = None
+    if INVENTORY:
+        inventory = SeatInventory(pool)
+        inventory.load()
+
+    # With LAB3_GROUP_COMMIT=1, purchases are queued and sold by a single
+    # writer thread, which commits whatever has piled up in one transaction
+    purchases = None
+    if GROUP_COMMIT:
+        purchases = GroupCommitQueue(pool, sell_ticket, batch_size=GROUP_COMMIT_BATCH,
+                                     max_wait=GROUP_COMMIT_WAIT_MS / 1000)
+
+    # Sales screens watch remainingSeats on the stream instead of
+    # polling; other workers' sales only show up as the shared version
+    # moving
+    performance_feed = ChangeFeed(changed_performances, all_performances, event='performance',
+                                  interval=STREAM_INTERVAL_MS / 1000,
+                                  watch=(lambda: cache.version({'performances'})) if WORKERS > 1 else None)
+    return app
+
+
+if __name__ == '__main__':
+    if WORKERS > 1 and not is_worker():
+        # The supervisor never serves: it only starts the versions over
+        # (and creates the schema, so workers don't race to) before
+        # running the workers, which each build their own app
+        check_settings()
+        init_db(DB_PATH, SCHEMA)
+        versions = SharedVersions(DB_PATH + '-versions', SHARED_TAGS, fresh=True)
+        app = None
+    else:
+        app = create_app()
+    serve(app, '127.0.0.1', PORT, server=SERVER, threads=THREADS, workers=WORKERS,
+          streams=('/performances/stream',))
@@ -0,0 +1,97 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# scrypt parameters for new hashes, ~16 MiB of memory per check
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * n * r * p, dklen=32)
+
+
+def hash_password(password):
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+# hashlib.scrypt releases the GIL, so a batch hashes in parallel (at
+# ~16 MiB a thread)
+_hashers = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='scrypt')
+
+
+def hash_passwords(passwords):
+    return list(_hashers.map(hash_password, passwords))
+
+
+def needs_rehash(stored):
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+def verify_password(password, stored):
+    if stored is None:
+        # Unknown user: do the same work as for a known one, so response
+        # times don't tell which user names exist
+        _scrypt(password, b'\0' * 16, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return False
+    if not stored.startswith("scrypt$"):
+        # Stored before we started hashing
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, n, r, p, salt, digest = stored.split("$")
+    found = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(found, bytes.fromhex(digest))
+
+
+class CredentialCache:
+    """
+    Remembers recently verified (user, password) pairs for `ttl`
+    seconds, so repeat purchases skip the KDF and the lookup. Only a
+    keyed hash of the password is kept, under a per-process secret.
+    Entries are also dropped when `generation()` (e.g. the version of
+    the customers, as other processes see it) has moved on since.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, generation=lambda: None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = generation
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, password):
+        return hmac.new(self._secret, password.encode(), hashlib.sha256).digest()
+
+    def check(self, user_name, password):
+        key = self._key(password)
+        with self._lock:
+            entry = self._entries.get(user_name)
+            if entry is None:
+                return False
+            cached, expires, generation = entry
+            if expires < time.monotonic() or generation != self.generation():
+                del self._entries[user_name]
+                return False
+            self._entries.move_to_end(user_name)
+        return hmac.compare_digest(cached, key)
+
+    def add(self, user_name, password):
+        key = self._key(password)
+        with self._lock:
+            self._entries[user_name] = (key, time.monotonic() + self.ttl, self.generation())
+            self._entries.move_to_end(user_name)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for the route handlers in app.py and blueprint.py.
+
+Each route is called in process through the WSGI app (no sockets),
+against generated datasets of a few sizes. Every (app, size) pair runs
+in a fresh subprocess with its own temporary database, since both apps
+keep their connections and caches in module globals. Results (timing and
+allocations per call) can be written to a JSON baseline and compared
+against an earlier one:
+
+    python bench.py --sizes 1000 100000 --output before.json
+    python bench.py --sizes 1000 100000 --compare before.json
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from wsgiref.util import setup_testing_defaults
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+THEATERS = [('Kino', 10), ('Regal', 16), ('Skandia', 100)]
+
+
+def call(app, method, path, body=None):
+    path, _, query = path.partition('?')
+    data = json.dumps(body).encode() if body is not None else b''
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(data)),
+        'wsgi.input': io.BytesIO(data),
+    }
+    setup_testing_defaults(environ)
+    status = []
+    chunks = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        size = sum(len(chunk) for chunk in chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return int(status[0].split()[0]), size
+
+
+def generate_movies(path, tickets):
+    screenings = max(10, tickets // 100)
+    movies = max(5, screenings // 5)
+    users = max(10, tickets // 10)
+    rnd = random.Random(tickets)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT OR IGNORE INTO theaters(theater_name, capacity) VALUES (?, ?)", THEATERS)
+    conn.executemany(
+        "INSERT INTO movies(imdb_key, movie_title, production_year) VALUES (?, ?, ?)",
+        ((f"tt{i:07}", f"Movie {i}", 1950 + i % 70) for i in range(movies)))
+    conn.executemany(
+        "INSERT INTO customers(user_name, full_name, password) VALUES (?, ?, ?)",
+        ((f"user{i}", f"User {i}", f"pwd{i}") for i in range(users)))
+    # Plenty of seats, so the purchase benchmark never sells out
+    conn.executemany(
+        """
+        INSERT INTO screenings(screening_id, start_time, start_date, theater_name, imdb_key, remaining_seats)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        ((f"{i:032x}", f"{12 + i % 10}:00", f"2021-03-{1 + i % 28:02}", THEATERS[i % 3][0],
+          f"tt{i % movies:07}", 10 ** 9) for i in range(screenings)))
+    conn.executemany(
+        "INSERT INTO tickets(user_name, screening_id) VALUES (?, ?)",
+        ((f"user{rnd.randrange(users)}", f"{rnd.randrange(screenings):032x}") for _ in range(tickets)))
+    conn.commit()
+    conn.close()
+    counter = iter(range(10 ** 9))
+    return [
+        ('GET /ping', 'GET', lambda: '/ping', None),
+        ('GET /movies', 'GET', lambda: '/movies', None),
+        ('GET /movies?limit=50', 'GET', lambda: '/movies?limit=50', None),
+        ('GET /movies?titlePrefix', 'GET', lambda: '/movies?titlePrefix=movie%201', None),
+        ('GET /movies/<imdbKey>', 'GET', lambda: f"/movies/tt{rnd.randrange(movies):07}", None),
+        ('GET /performances', 'GET', lambda: '/performances', None),
+        ('GET /performances?limit=50', 'GET', lambda: '/performances?limit=50', None),
+        ('GET /users/<username>/tickets', 'GET', lambda: f"/users/user{rnd.randrange(users)}/tickets", None),
+        ('POST /users', 'POST', lambda: '/users',
+         lambda: {"username": f"bench{next(counter)}", "fullName": "Bench", "pwd": "bench"}),
+        ('POST /tickets', 'POST', lambda: '/tickets',
+         lambda: {"username": "user0", "pwd": "pwd0", "performanceId": f"{rnd.randrange(screenings):032x}"}),
+    ]
+
+
+def generate_students(path, students):
+    rnd = random.Random(students)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO students(s_id, s_name, gpa, size_hs) VALUES (?, ?, ?, ?)",
+        ((i, f"Student {i}", round(rnd.uniform(2.0, 4.0), 2), rnd.randrange(100, 3000)) for i in range(students)))
+    conn.commit()
+    conn.close()
+    counter = iter(range(students, 10 ** 9))
+    return [
+        ('GET /students', 'GET', lambda: '/students', None),
+        ('GET /students?minGpa', 'GET', lambda: '/students?minGpa=3.9', None),
+        ('GET /students?name', 'GET', lambda: f"/students?name=Student%20{rnd.randrange(students)}", None),
+        ('GET /students?limit=50', 'GET', lambda: '/students?limit=50', None),
+        ('GET /students/<s_id>', 'GET', lambda: f"/students/{rnd.randrange(students)}", None),
+        ('POST /students', 'POST', lambda: '/students',
+         lambda: {"id": next(counter), "name": "Bench", "gpa": 3.0}),
+    ]
+
+
+APPS = {
+    'movies': ('app', generate_movies),
+    'students': ('blueprint', generate_students),
+}
+
+
+def run_cases(module, app, cases, repeat):
+    cache = getattr(module, 'cache', None)
+    results = {}
+    for name, method, path, body in cases:
+        def once():
+            # Measure the handler, not the response cache
+            if cache is not None:
+                cache.invalidate({'movies', 'performances'})
+            status, size = call(app, method, path(), body() if body else None)
+            if status >= 400:
+                raise RuntimeError(f"{name} answered {status}")
+            return size
+
+        for _ in range(3):
+            once()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            size = once()
+            timings.append(time.perf_counter_ns() - start)
+
+        tracemalloc.start()
+        allocated = []
+        for _ in range(max(1, repeat // 10)):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            once()
+            _, peak = tracemalloc.get_traced_memory()
+            allocated.append(peak - before)
+        tracemalloc.stop()
+
+        timings.sort()
+        results[name] = {
+            "median_us": statistics.median(timings) / 1000,
+            "p95_us": timings[int(0.95 * (len(timings) - 1))] / 1000,
+            "mean_us": statistics.fmean(timings) / 1000,
+            "peak_alloc_kib": statistics.median(allocated) / 1024,
+            "response_bytes": size,
+        }
+    return results
+
+
+def child(app_name, size, repeat):
+    module_name, generate = APPS[app_name]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite')
+        sys.path.insert(0, HERE)
+        module = importlib.import_module(module_name)
+        app = module.create_app(path)
+        cases = generate(path, size)
+        results = run_cases(module, app, cases, repeat)
+        module.pool.close()
+    json.dump(results, sys.stdout)
+
+
+def run_all(apps, sizes, repeat):
+    results = {}
+    for app_name in apps:
+        for size in sizes:
+            print(f"benchmarking {app_name} with {size} rows", file=sys.stderr)
+            out = subprocess.run(
+                [sys.executable, __file__, '--child', app_name, str(size), '--repeat', str(repeat)],
+                check=True, capture_output=True, text=True).stdout
+            for route, numbers in json.loads(out).items():
+                results[f"{app_name}/{size}/{route}"] = numbers
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None, threshold=1.25):
+    regressions = []
+    print(f"{'benchmark':<52}{'median us':>12}{'p95 us':>12}{'alloc KiB':>12}{'vs base':>10}")
+    for key, numbers in results.items():
+        line = (f"{key:<52}{numbers['median_us']:>12.1f}{numbers['p95_us']:>12.1f}"
+                f"{numbers['peak_alloc_kib']:>12.1f}")
+        if baseline and key in baseline:
+            ratio = numbers['median_us'] / baseline[key]['median_us']
+            line += f"{ratio:>9.2f}x"
+            if ratio > threshold:
+                regressions.append(key)
+                line += "  <-- regression"
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Lab3 route handlers in process")
+    parser.add_argument('--apps', nargs='+', choices=sorted(APPS), default=sorted(APPS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000],
+                        help="rows to generate (tickets for movies, students for students)")
+    parser.add_argument('--repeat', type=int, default=200, help="timed calls per route")
+    parser.add_argument('--output', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', help="compare against an earlier JSON baseline")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="median slowdown (new / baseline) counted as a regression")
+    parser.add_argument('--child', nargs=2, metavar=('APP', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], int(args.child[1]), args.repeat)
+        return
+
+    results = run_all(args.apps, args.sizes, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    regressions = report(results, baseline, args.threshold)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"commit": git_commit(),
+                       "python": platform.python_version(),
+                       "sqlite": sqlite3.sqlite_version,
+                       "repeat": args.repeat,
+                       "results": results}, f, indent=2)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold}x", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
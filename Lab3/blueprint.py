@@ -1,40 +1,95 @@
 
-from bottle import get, post, run, request, response
+from bottle import Bottle, JSONPlugin, request, response
+import os
 import sqlite3
 from urllib.parse import unquote
 
-PORT = 4567
+from database import ConnectionPool, PoolPlugin, init_db
+from listing import listing, page_params, sql_limit
+from querybuilder import QueryBuilder
+import serializer
+from servers import serve
 
+PORT = int(os.environ.get('LAB3_PORT', 4567))
 
-db = sqlite3.connect('colleges.sqlite')
+DB_PATH = os.environ.get('LAB3_DB', 'colleges.sqlite')
+SERVER = os.environ.get('LAB3_SERVER', 'threadpool')
+THREADS = int(os.environ.get('LAB3_THREADS', os.cpu_count() or 4))
+POOL_SIZE = int(os.environ.get('LAB3_POOL_SIZE', THREADS))
+STATEMENT_CACHE = int(os.environ.get('LAB3_STATEMENT_CACHE', 128))
+JSON_ENCODER = os.environ.get('LAB3_JSON', 'auto')
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'colleges.sql')
 
 
-@get('/students')
-def get_students():
-    query = """
+app = Bottle()
+# Set up by create_app()
+pool = None
+
+
+def student_row(cursor, row):
+    id, name, grade = row
+    return {"id": id, "name": name, "gpa": grade}
+
+
+STUDENTS_QUERY = QueryBuilder(
+    """
         SELECT   s_id, s_name, gpa
         FROM     students
-        WHERE    TRUE
-        """
-    params = []
-
-    if request.query.name:
-        query += "AND s_name = ?"
-        params.append(unquote(request.query.name))
-    if request.query.minGpa:
-        query += "AND gpa >= ?"
-        params.append(request.query.minGpa)
+    """,
+    filters={
+        'name': "s_name = ?",
+        'minGpa': "gpa >= ?",
+        'maxGpa': "gpa <= ?",
+        'ids': "s_id IN ({})",
+        'after': "s_id > ?",
+    },
+    orderings={
+        'id': "s_id",
+        'name': "s_name, s_id",
+        'gpa': "gpa, s_id",
+        '-gpa': "gpa DESC, s_id",
+    },
+)
+
+
+@app.get('/students')
+def get_students(db):
+    filters = {}
+    try:
+        if request.query.name:
+            filters['name'] = unquote(request.query.name)
+        if request.query.minGpa:
+            filters['minGpa'] = float(request.query.minGpa)
+        if request.query.maxGpa:
+            filters['maxGpa'] = float(request.query.maxGpa)
+        if request.query.ids:
+            filters['ids'] = [int(s_id) for s_id in request.query.ids.split(',')]
+    except ValueError:
+        response.status = 400
+        return "Malformed filter"
+    order = request.query.order or 'id'
+    if order not in STUDENTS_QUERY.orderings:
+        response.status = 400
+        return f"order must be one of {', '.join(STUDENTS_QUERY.orderings)}"
+    limit, after = page_params()
+    if after is not None:
+        # The cursor is a student id, so it only works in id order
+        if order != 'id':
+            response.status = 400
+            return "after can only be used when ordering by id"
+        filters['after'] = after
+    query, params = STUDENTS_QUERY.build(filters, order, sql_limit(limit))
     c = db.cursor()
+    c.row_factory = student_row
     c.execute(
         query,
         params
     )
     response.status = 200
-    found = [{"id": id, "name": name, "gpa": grade} for id, name, grade in c]
-    return {"data": found}
+    return listing(c, limit, key=lambda student: student["id"])
 
 
-def first_get_students():
+def first_get_students(db):
     c = db.cursor()
     c.execute(
         """
@@ -47,9 +102,10 @@ def first_get_students():
     return {"data": found}
 
 
-@get('/students/<s_id>')
-def get_student(s_id):
+@app.get('/students/<s_id>')
+def get_student(s_id, db):
     c = db.cursor()
+    c.row_factory = student_row
     c.execute(
         """
         SELECT   s_id, s_name, gpa
@@ -58,17 +114,15 @@ def get_student(s_id):
         """,
         [s_id]
     )
-    found = [{"id": id,
-              "name": name,
-              "gpa": grade} for id, name, grade in c]
+    found = c.fetchall()
     if len(found) == 0:
         response.status = 404
         return "Didn't find student"
     return {"data": found}
 
 
-@post('/students')
-def post_student():
+@app.post('/students')
+def post_student(db):
     student = request.json
     c = db.cursor()
     try:
@@ -95,4 +149,22 @@ def post_student():
         return "Student id already in use"
 
 
-run(host='localhost', port=PORT)
+def create_app(db_path=DB_PATH):
+    """
+    Sets up the app for the database at `db_path` (creating its schema
+    if need be) and returns it. Connections are opened as requests need
+    them.
+    """
+    global pool
+    init_db(db_path, SCHEMA)
+    if pool is not None:
+        pool.close()
+    pool = ConnectionPool(db_path, size=POOL_SIZE, cached_statements=STATEMENT_CACHE)
+    app.uninstall(True)
+    app.install(JSONPlugin(serializer.use(JSON_ENCODER)))
+    app.install(PoolPlugin(pool))
+    return app
+
+
+if __name__ == '__main__':
+    serve(create_app(), 'localhost', PORT, server=SERVER, threads=THREADS)
@@ -0,0 +1,231 @@
+import mmap
+import os
+import struct
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from bottle import request, response
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no prefork workers, so no SharedVersions either
+    fcntl = None
+
+import serializer
+from compression import answer_encoded, vary_on_encoding
+
+
+class ResponseCache:
+    """
+    A bounded LRU cache of encoded JSON responses. Each entry is
+    tagged with the data it was built from (e.g. 'movies'), and
+    invalidating a tag drops every entry carrying it and bumps the
+    tag's version, which is also what our ETags are made of. An entry
+    is a dict of the body's variants, by Content-Encoding (None for
+    the body as is), so compressing it only happens once.
+
+    The versions are a Counter by default; worker processes serving the
+    same database share theirs through SharedVersions instead, so a
+    write in one of them is seen by the caches of all the others.
+    """
+
+    def __init__(self, maxsize=256, versions=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._entries = OrderedDict()
+        self._versions = Counter() if versions is None else versions
+        # Versions restart at 0 with the process, the epoch keeps an
+        # ETag from an earlier run from matching
+        self.epoch = getattr(versions, 'epoch', None) or uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+
+    def version(self, tags):
+        with self._lock:
+            return tuple(self._versions[tag] for tag in sorted(tags))
+
+    def etag(self, version, encoding=None):
+        tag = '%s-%s' % (self.epoch, '.'.join(map(str, version)))
+        if encoding is not None:
+            tag += '-' + encoding
+        return f'"{tag}"'
+
+    def note_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            # Another process may have moved the versions on, without
+            # dropping our entries
+            if entry is not None and entry[2] != version:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, body, tags, version):
+        """Returns the entry's variants, to add compressed ones to."""
+        variants = {None: body}
+        with self._lock:
+            # Someone wrote to the tables while we were reading them
+            if version != tuple(self._versions[tag] for tag in sorted(tags)):
+                return variants
+            self._entries[key] = (variants, tags, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return variants
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._versions.update(tags)
+            stale = [key for key, (_, entry_tags, _) in self._entries.items() if entry_tags & tags]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "notModified": self.not_modified,
+                    "entries": len(self._entries), "maxsize": self.maxsize}
+
+
+class SharedVersions:
+    """
+    Tag versions kept in a small memory-mapped file (next to the
+    database), for processes sharing one. Reads go straight to the
+    mapping, bumps are serialized with a lock on the file. Only the
+    `tags` given can be versioned. The first process (`fresh=True`)
+    starts them over, with a new epoch.
+    """
+
+    def __init__(self, path, tags, fresh=False):
+        if fcntl is None:
+            raise RuntimeError("shared versions need fcntl (not on Windows)")
+        self.slots = {tag: 16 + 8 * i for i, tag in enumerate(sorted(tags))}
+        size = 16 + 8 * len(self.slots)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            if fresh or os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, 0)
+                os.write(self._fd, uuid.uuid4().hex[:8].encode().ljust(size, b'\0'))
+        self._map = mmap.mmap(self._fd, size)
+        self.epoch = self._map[:8].decode()
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __getitem__(self, tag):
+        return struct.unpack_from('<Q', self._map, self.slots[tag])[0]
+
+    def update(self, tags):
+        with self._locked():
+            for tag in tags:
+                struct.pack_into('<Q', self._map, self.slots[tag], self[tag] + 1)
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class CachePlugin:
+    """
+    Bottle plugin driven by route config: routes declared with
+    `cache=('movies',)` are served from the cache with an ETag (and
+    answer a matching If-None-Match with 304), routes declared
+    with `invalidates=('movies',)` drop those tags once they've run.
+    Install it before PoolPlugin, so cache hits never check out a
+    connection. With a Compressor, cached bodies are also served (and
+    kept) compressed, each encoding with its own ETag.
+    """
+
+    name = 'cache'
+    api = 2
+
+    def __init__(self, cache, compressor=None):
+        self.cache = cache
+        self.compressor = compressor
+
+    def apply(self, callback, route):
+        tags = route.config.get('cache')
+        invalidates = route.config.get('invalidates')
+        if tags:
+            return self._cached(callback, frozenset(tags))
+        if invalidates:
+            return self._invalidating(callback, frozenset(invalidates))
+        return callback
+
+    def _cached(self, callback, tags):
+        cache = self.cache
+        compressor = self.compressor
+
+        def wrapper(*args, **kwargs):
+            version = cache.version(tags)
+            encoding = None
+            if compressor is not None:
+                encoding = compressor.choose(request.headers.get('Accept-Encoding'))
+                vary_on_encoding()
+            # Bodies under the size threshold go out as they are, so the
+            # client may hold either
+            if_none_match = request.headers.get('If-None-Match')
+            for etag in {cache.etag(version), cache.etag(version, encoding)}:
+                if etag_matches(if_none_match, etag):
+                    cache.note_not_modified()
+                    response.status = 304
+                    response.set_header('ETag', etag)
+                    return ''
+            key = f"{request.path}?{request.query_string}"
+            variants = cache.get(key, version)
+            if variants is None:
+                result = callback(*args, **kwargs)
+                # What a lagging replica answered would outlive its
+                # budget in here
+                if (not isinstance(result, dict) or response.status_code != 200
+                        or response.get_header('X-Replica-Lag', '0') != '0'):
+                    return result
+                variants = cache.put(key, serializer.dumps(result), tags, version)
+            response.content_type = 'application/json'
+            body = variants[None]
+            if encoding is None or len(body) < compressor.min_size:
+                response.set_header('ETag', cache.etag(version))
+                return body
+            encoded = variants.get(encoding)
+            if encoded is None:
+                # Racing requests may both compress it, same bytes either way
+                encoded = variants[encoding] = compressor.compress(body, encoding)
+            response.set_header('ETag', cache.etag(version, encoding))
+            return answer_encoded(encoded, encoding)
+
+        return wrapper
+
+    def _invalidating(self, callback, tags):
+        cache = self.cache
+
+        def wrapper(*args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                cache.invalidate(tags)
+
+        return wrapper
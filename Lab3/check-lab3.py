@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 
-from collections import Counter
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import io
 import itertools
 import json
+import os
 import random
 import re
 import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+import sys
+import tempfile
+import threading
+import time
 import urllib.parse
 
 
@@ -44,6 +54,89 @@ def url(resource):
     return f"http://{HOST}:{PORT}{resource}"
 
 
+class WSGIAdapter(BaseAdapter):
+    """
+    Sends requests straight to a WSGI app in this process, instead of
+    over a socket (see --in-process).
+    """
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def send(self, request, **kwargs):
+        parts = urllib.parse.urlsplit(request.url)
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode()
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(parts.path, 'latin-1'),
+            'QUERY_STRING': parts.query,
+            'SERVER_NAME': HOST,
+            'SERVER_PORT': str(PORT),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = name.upper().replace('-', '_')
+            # We hand back the body as is, so don't ask for it compressed
+            if key == 'ACCEPT_ENCODING':
+                continue
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+
+        chunks = self.app(environ, start_response)
+        try:
+            content = b"".join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        r = requests.Response()
+        code, _, r.reason = started['status'].partition(' ')
+        r.status_code = int(code)
+        r.headers = CaseInsensitiveDict(started['headers'])
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r._content = content
+        r.url = request.url
+        r.request = request
+        r.connection = self
+        return r
+
+    def close(self):
+        pass
+
+
+# Set by --in-process
+_adapter = None
+
+
+def new_session():
+    session = requests.Session()
+    if _adapter is not None:
+        session.mount(url(""), _adapter)
+    return session
+
+
+http = new_session()
+
+
 def response_to_dicts(r):
     return list(dict(d) for d in r.json()['data'])
 
@@ -87,7 +180,7 @@ def check_ping():
     resource = url("/ping")
     check("GET", resource)
     try:
-        r = requests.get(resource)
+        r = http.get(resource)
         require(r.status_code, 200)
         require(r.text.strip(), 'pong')
         ok("GET", resource)
@@ -100,7 +193,7 @@ def check_reset():
     resource = url("/reset")
     check("POST", resource)
     try:
-        r = requests.post(resource)
+        r = http.post(resource)
         # require(r.status_code, 205)
         ok("POST", resource)
     except Exception as e:
@@ -114,7 +207,7 @@ def check_post_user():
     try:
         for username, full_name, pwd in USERS:
             payload = {"username": username, "fullName": full_name, "pwd": pwd}
-            r = requests.post(resource, json=payload)
+            r = http.post(resource, json=payload)
             require(r.text.strip(), f"/users/{username}")
         ok("POST", resource)
     except Exception as e:
@@ -128,7 +221,7 @@ def check_post_movie():
     try:
         for title, imdb_key, year in MOVIES:
             payload = {"imdbKey": imdb_key, "title": title, "year": year}
-            r = requests.post(resource, json=payload)
+            r = http.post(resource, json=payload)
             require(r.text.strip(), f"/movies/{imdb_key}")
         ok("POST", resource)
     except Exception as e:
@@ -143,7 +236,7 @@ def check_post_performances():
     try:
         for imdb_key, theater, date, time in PERFORMANCES:
             payload = {"imdbKey": imdb_key, "theater": theater, "date": date, "time": time}
-            r = requests.post(resource, json=payload)
+            r = http.post(resource, json=payload)
             m = re.match("/performances/(.+)", r.text.strip())
             if not m:
                 abort_on_resource("POST", resource, f"does not return a valid resource ({r.text.strip()})")
@@ -161,7 +254,7 @@ def check_get_movies():
     resource = url("/movies")
     check("GET", resource)
     try:
-        r = requests.get(resource)
+        r = http.get(resource)
         movies = response_to_dicts(r)
         expected = set(imdb_key for _,imdb_key,_ in MOVIES)
         found = set(movie['imdbKey'] for movie in movies)
@@ -176,7 +269,7 @@ def check_get_movies_with_query(title,year):
     resource = url(f"/movies?title={urllib.parse.quote(title)}&year={year}")
     check("GET", resource)
     try:
-        r = requests.get(resource)
+        r = http.get(resource)
         movies = response_to_dicts(r)
         expected = set(imdb_key for t,imdb_key,y in MOVIES if t == title and y == year)
         found = set(movie['imdbKey'] for movie in movies)
@@ -197,7 +290,7 @@ def check_get_movies_with_id(imdb_key):
     resource = url(f"/movies/{imdb_key}")
     check("GET", resource)
     try:
-        r = requests.get(resource)
+        r = http.get(resource)
         movies = response_to_dicts(r)
         expected = set(imdb_key for _,key,_ in MOVIES if key == imdb_key)
         found = set(movie['imdbKey'] for movie in movies)
@@ -219,7 +312,7 @@ def check_get_performances(actual_performances):
     resource = url("/performances")
     check("GET", resource)
     try:
-        r = requests.get(resource)
+        r = http.get(resource)
         returned_performances = response_to_dicts(r)
         expected = set(actual_performances)
         found = set(performance['performanceId'] for performance in returned_performances)
@@ -243,7 +336,7 @@ def random_user():
 
 def check_ticket_hoarding():
     show_progress('check_ticket_hoarding')
-    r = requests.get(url("/performances"))
+    r = http.get(url("/performances"))
     found_performances = response_to_dicts(r)
     seats_left = {p['performanceId']: p['remainingSeats'] for p in found_performances}
     perf_ids = [[p_id] * (count+2) for p_id, count in seats_left.items()]
@@ -255,7 +348,7 @@ def check_ticket_hoarding():
     for p_id in all_attempts:
         username,_,pwd = random_user()
         payload = {"username": username, "pwd": pwd, "performanceId": p_id}
-        r = requests.post(resource, json=payload)
+        r = http.post(resource, json=payload)
         if seats_left[p_id] > 0:
             require(r.status_code, 201)
             require(valid_ticket(r.text), True, f"{r.text.strip()} is not a valid ticket resource")
@@ -265,14 +358,14 @@ def check_ticket_hoarding():
             require(r.status_code, 400)
             require(r.text.strip(), "No tickets left")
     ok("POST", resource)
-    r = requests.get(url("/performances"))
+    r = http.get(url("/performances"))
     for p in response_to_dicts(r):
         require(p['remainingSeats'], 0, "after a ticket sales bonanza, there should be no tickets left for the performances")
     ok("GET", url("/performances"))
     perf_id_lookup = create_performance_id_lookup()
     for username, counts in users.items():
         resource = url(f"/users/{username}/tickets")
-        r = requests.get(resource)
+        r = http.get(resource)
         summary = response_to_dicts(r)
         for perf_info in summary:
             date = perf_info["date"]
@@ -283,7 +376,7 @@ def check_ticket_hoarding():
 
 
 def create_performance_id_lookup():
-    r = requests.get(url("/performances"))
+    r = http.get(url("/performances"))
     perf_lookup = dict()
     for p in response_to_dicts(r):
         perf_id = p["performanceId"]
@@ -294,6 +387,115 @@ def create_performance_id_lookup():
     return perf_lookup
 
 
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class LoadStats:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.sold = Counter()
+        self.sold_to = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def record(self, route, seconds):
+        with self.lock:
+            self.latencies[route].append(seconds)
+
+    def record_sale(self, username, p_id):
+        with self.lock:
+            self.sold[p_id] += 1
+            self.sold_to[username][p_id] += 1
+
+    def report(self, elapsed):
+        print(f"{'route':<32}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            print(f"{route:<32}{len(latencies):>10}{len(latencies) / elapsed:>10.1f}"
+                  f"{percentile(latencies, 50) * 1000:>10.1f}"
+                  f"{percentile(latencies, 95) * 1000:>10.1f}"
+                  f"{percentile(latencies, 99) * 1000:>10.1f}")
+
+
+_sessions = threading.local()
+
+
+def timed(stats, route, method, resource, **kwargs):
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = new_session()
+    start = time.perf_counter()
+    r = session.request(method, resource, **kwargs)
+    stats.record(route, time.perf_counter() - start)
+    return r
+
+
+def buyer(stats, performance_ids, purchases):
+    for _ in range(purchases):
+        username, _, pwd = random_user()
+        p_id = random.choice(performance_ids)
+        payload = {"username": username, "pwd": pwd, "performanceId": p_id}
+        r = timed(stats, "POST /tickets", "POST", url("/tickets"), json=payload)
+        if r.status_code == 201:
+            require(valid_ticket(r.text), True, f"{r.text.strip()} is not a valid ticket resource")
+            stats.record_sale(username, p_id)
+        else:
+            require((r.status_code, r.text.strip()), (400, "No tickets left"))
+
+
+def browser(stats, browses):
+    routes = [("GET /movies", "/movies"),
+              ("GET /performances", "/performances")]
+    routes += [("GET /users/<username>/tickets", f"/users/{username}/tickets") for username, _, _ in USERS]
+    for _ in range(browses):
+        route, resource = random.choice(routes)
+        r = timed(stats, route, "GET", url(resource))
+        require(r.status_code, 200)
+
+
+def check_load(buyers, browsers, purchases, browses):
+    """
+    Sets up the fixtures, then lets `buyers` threads make `purchases`
+    ticket attempts each while `browsers` threads make `browses` reads
+    each. Reports latency and throughput per route, and checks that no
+    performance was oversold.
+    """
+    check_ping()
+    check_reset()
+    check_post_user()
+    check_post_movie()
+    performance_ids = check_post_performances()
+    show_progress('check_load')
+    print(f"   {buyers} buyers x {purchases} purchases, {browsers} browsers x {browses} reads")
+    stats = LoadStats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=buyers + browsers) as executor:
+        futures = [executor.submit(buyer, stats, performance_ids, purchases) for _ in range(buyers)]
+        futures += [executor.submit(browser, stats, browses) for _ in range(browsers)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+    stats.report(elapsed)
+
+    show_progress('check_load (consistency)')
+    for p in response_to_dicts(http.get(url("/performances"))):
+        p_id = p["performanceId"]
+        capacity = THEATER_SIZES[p["theater"]]
+        sold = stats.sold[p_id]
+        require(sold <= capacity, True, f"{sold} tickets sold for {p_id}, which only has {capacity} seats")
+        require(p["remainingSeats"], capacity - sold, f"remainingSeats for {p_id} doesn't match the tickets sold")
+    perf_id_lookup = create_performance_id_lookup()
+    for username, counts in stats.sold_to.items():
+        for perf_info in response_to_dicts(http.get(url(f"/users/{username}/tickets"))):
+            p_id = perf_id_lookup[(perf_info["theater"], perf_info["date"], perf_info["startTime"])]
+            require(perf_info["nbrOfTickets"], counts[p_id], "the number of tickets for a user doesn't add up")
+    ok("GET", url("/performances"))
+
+
 def main():
     check_ping()
     check_reset()
@@ -301,7 +503,7 @@ def main():
     check_post_movie()
     performances = check_post_performances()
     check_get_movies()
-    # check_get_movies_with_queries()
+    check_get_movies_with_queries()
     check_get_movies_with_ids()
     check_get_performances(performances)
     check_ticket_hoarding()
@@ -313,4 +515,22 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load', action='store_true', help="run concurrent buyers and browsers instead of the checks")
+    parser.add_argument('--buyers', type=int, default=16)
+    parser.add_argument('--browsers', type=int, default=16)
+    parser.add_argument('--purchases', type=int, default=20, help="ticket attempts per buyer")
+    parser.add_argument('--browses', type=int, default=50, help="reads per browser")
+    parser.add_argument('--in-process', action='store_true',
+                        help="call app.py's WSGI app directly, on a temporary database, instead of a running server")
+    args = parser.parse_args()
+    if args.in_process:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from app import create_app
+        tmp = tempfile.TemporaryDirectory()
+        _adapter = WSGIAdapter(create_app(os.path.join(tmp.name, 'movies.sqlite')))
+        http.mount(url(""), _adapter)
+    if args.load:
+        check_load(args.buyers, args.browsers, args.purchases, args.browses)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS students (
+  s_id          INTEGER,
+  s_name        TEXT,
+  gpa           REAL,
+  size_hs       INT,
+  PRIMARY KEY  (s_id)
+);
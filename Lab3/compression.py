@@ -0,0 +1,96 @@
+import gzip
+
+from bottle import request, response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compressor:
+    """
+    Picks a Content-Encoding from a request's Accept-Encoding (brotli
+    when it's installed and the client takes it, then gzip), and
+    compresses response bodies of at least `min_size` bytes with it.
+    """
+
+    def __init__(self, min_size=1024, level=6):
+        self.min_size = min_size
+        self.encodings = {}
+        if brotli is not None:
+            self.encodings['br'] = lambda body: brotli.compress(body, quality=min(level, 11))
+        # mtime=0 so the same body always compresses to the same bytes
+        self.encodings['gzip'] = lambda body: gzip.compress(body, compresslevel=level, mtime=0)
+
+    def choose(self, accept_encoding):
+        """The encoding to answer with, None for identity."""
+        if not accept_encoding:
+            return None
+        weights = {}
+        for part in accept_encoding.split(','):
+            name, _, params = part.strip().partition(';')
+            weight = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    weight = float(params[2:])
+                except ValueError:
+                    continue
+            weights[name.strip().lower()] = weight
+        default = weights.get('*', 0)
+        # Ties go to the first one we know (the smallest output)
+        best, best_weight = None, 0
+        for name in self.encodings:
+            weight = weights.get(name, default)
+            if weight > best_weight:
+                best, best_weight = name, weight
+        return best
+
+    def compress(self, body, encoding):
+        return self.encodings[encoding](body)
+
+
+def vary_on_encoding():
+    if 'Accept-Encoding' not in response.get_header('Vary', ''):
+        response.add_header('Vary', 'Accept-Encoding')
+
+
+def answer_encoded(body, encoding):
+    response.set_header('Content-Encoding', encoding)
+    vary_on_encoding()
+    return body
+
+
+class CompressionPlugin:
+    """
+    Bottle plugin compressing the bodies routes answer with, when the
+    client accepts an encoding and the body is big enough. Install it
+    first, so it sees the JSON rather than the dicts. Streamed
+    (generator) responses and bodies a plugin has already encoded (the
+    response cache keeps its compressed variants) are passed through.
+    """
+
+    name = 'compression'
+    api = 2
+
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def apply(self, callback, route):
+        compressor = self.compressor
+
+        def wrapper(*args, **kwargs):
+            body = callback(*args, **kwargs)
+            if isinstance(body, str):
+                body = body.encode(response.charset or 'utf-8')
+            if (not isinstance(body, bytes) or len(body) < compressor.min_size
+                    or response.status_code != 200 or 'Content-Encoding' in response.headers):
+                return body
+            encoding = compressor.choose(request.headers.get('Accept-Encoding'))
+            vary_on_encoding()
+            if encoding is None:
+                return body
+            return answer_encoded(compressor.compress(body, encoding), encoding)
+
+        return wrapper
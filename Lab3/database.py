@@ -0,0 +1,261 @@
+import functools
+import inspect
+import math
+import queue
+import sqlite3
+import threading
+import types
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+from bottle import response
+
+
+# Applied to every connection we open (journal_mode is set once, in
+# init_db, since WAL is persistent in the database file)
+PRAGMAS = {
+    'foreign_keys': 'ON',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'mmap_size': 64 * 1024 * 1024,
+}
+
+
+def configure(conn, pragmas=PRAGMAS):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def init_db(path, schema=None):
+    """
+    Switches the database to WAL journaling and creates whatever
+    tables (and indexes) in the `schema` script are missing.
+    """
+    conn = configure(sqlite3.connect(path))
+    try:
+        mode, = conn.execute("PRAGMA journal_mode = WAL").fetchone()
+        if mode.lower() != 'wal':
+            raise sqlite3.OperationalError(f"could not enable WAL, journal_mode is {mode}")
+        if schema is not None:
+            conn.executescript(Path(schema).read_text())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def full_scans(conn, sql):
+    """Returns the tables `sql` would read in full, according to EXPLAIN QUERY PLAN."""
+    tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    params = [None] * sql.count('?')
+    scanned = set()
+    for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+        words = detail.split()
+        if words[0] != 'SCAN':
+            continue
+        # SQLite before 3.36 says "SCAN TABLE movies", later "SCAN movies"
+        table = words[2] if words[1] == 'TABLE' and len(words) > 2 else words[1]
+        if table in tables:
+            scanned.add(table)
+    return scanned
+
+
+def check_query_plans(path, queries):
+    """
+    `queries` maps a route to its SQL and the set of tables it is
+    allowed to scan in full; any other full scan raises QueryPlanError.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        problems = []
+        for route, (sql, allowed) in queries.items():
+            for table in sorted(full_scans(conn, sql) - set(allowed)):
+                problems.append(f"{route} scans all of {table}")
+        if problems:
+            raise QueryPlanError("; ".join(problems))
+    finally:
+        conn.close()
+
+
+class Snapshots:
+    """
+    Prebuilt in-memory databases, one per seed script in `seed_dir`
+    (the schema plus `<name>.sql`), which restore() copies over a live
+    database with SQLite's online backup API. This takes the same time
+    however much data the live database has.
+    """
+
+    def __init__(self, schema, seed_dir):
+        self.schema = Path(schema)
+        self.seed_dir = Path(seed_dir)
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    @property
+    def names(self):
+        return sorted(path.stem for path in self.seed_dir.glob('*.sql'))
+
+    def _template(self, name, page_size):
+        # The backup only works into a database with the same page size
+        template = self._templates.get((name, page_size))
+        if template is None:
+            template = sqlite3.connect(':memory:', check_same_thread=False)
+            template.execute(f"PRAGMA page_size = {int(page_size)}")
+            template.executescript(self.schema.read_text())
+            template.executescript((self.seed_dir / f"{name}.sql").read_text())
+            template.commit()
+            self._templates[name, page_size] = template
+        return template
+
+    def restore(self, name, conn):
+        if name not in self.names:
+            raise KeyError(name)
+        page_size, = conn.execute("PRAGMA page_size").fetchone()
+        with self._lock:
+            self._template(name, page_size).backup(conn)
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+class ConnectionPool:
+    """
+    A bounded set of read-only connections for GET routes, and one
+    dedicated writer connection (guarded by a lock) for everything else.
+    Connections are opened lazily, the first time they are needed. The
+    `on_write` callables are called each time the writer is handed back.
+    """
+
+    def __init__(self, path, size=4, cached_statements=128, factory=sqlite3.Connection):
+        self.path = path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.factory = factory
+        self._readers = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self.on_write = []
+
+    def connect(self, readonly=False):
+        if readonly:
+            uri = Path(self.path).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   cached_statements=self.cached_statements,
+                                   factory=self.factory)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   cached_statements=self.cached_statements,
+                                   factory=self.factory)
+        return configure(conn)
+
+    @contextmanager
+    def reader(self):
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            conn = self.connect(readonly=True) if create else self._readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        try:
+            with self._write_lock:
+                if self._writer is None:
+                    self._writer = self.connect()
+                try:
+                    yield self._writer
+                finally:
+                    # Whatever a handler didn't commit is thrown away
+                    if self._writer.in_transaction:
+                        self._writer.rollback()
+        finally:
+            for callback in self.on_write:
+                callback()
+
+    def close(self):
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+class PoolPlugin:
+    """
+    Bottle plugin which passes a pooled connection to every route
+    taking a `db` argument: a reader for GET routes, the writer for
+    the rest. Routes returning a generator keep their connection until
+    the response has been streamed.
+
+    With a `replica`, GET routes declared with e.g. `replica='movies'`
+    read from its in-memory copy instead, as long as that lags at most
+    the budget of that name, and say by how much (in milliseconds,
+    rounded up) in an X-Replica-Lag header.
+    """
+
+    name = 'pool'
+    api = 2
+
+    def __init__(self, pool, keyword='db', replica=None):
+        self.pool = pool
+        self.keyword = keyword
+        self.replica = replica
+
+    def apply(self, callback, route):
+        if self.keyword not in inspect.signature(route.callback).parameters:
+            return callback
+        budget = route.config.get('replica')
+        if route.method in ('GET', 'HEAD') and self.replica is not None and budget in self.replica.budgets:
+            checkout = functools.partial(_from_replica, self.replica, self.replica.budgets[budget])
+        elif route.method in ('GET', 'HEAD'):
+            checkout = self.pool.reader
+        else:
+            checkout = self.pool.writer
+
+        def wrapper(*args, **kwargs):
+            stack = ExitStack()
+            kwargs[self.keyword] = stack.enter_context(checkout())
+            try:
+                result = callback(*args, **kwargs)
+            except BaseException:
+                stack.close()
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _release_after(result, stack)
+            stack.close()
+            return result
+
+        return wrapper
+
+
+def _release_after(rows, stack):
+    with stack:
+        yield from rows
+
+
+@contextmanager
+def _from_replica(replica, max_age):
+    with replica.reader(max_age) as (conn, lag):
+        if lag is not None:
+            response.set_header('X-Replica-Lag', str(math.ceil(lag * 1000)))
+        yield conn
@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+
+from bottle import response
+
+import serializer
+
+
+log = logging.getLogger('lab3.events')
+
+
+def sse(event, data):
+    """One server-sent event, its data as JSON."""
+    return b"event: " + event.encode() + b"\ndata: " + serializer.dumps(data) + b"\n\n"
+
+
+class _Subscriber:
+
+    def __init__(self, backlog):
+        self.queue = queue.Queue(maxsize=backlog)
+        self.dropped = False
+
+
+class ChangeFeed:
+    """
+    Streams changes to items (e.g. performances) to any number of
+    subscribers as server-sent events. publish(key) marks an item as
+    changed; every `interval` seconds one thread fetches all the
+    changed items at once (`fetch(keys)`, whatever the number of
+    subscribers) and sends each subscriber one `event` per item, so a
+    burst of changes to an item makes at most one event per interval.
+
+    With `watch` (a callable returning a version other processes bump
+    too), we can't know what changed, so a new version sends everyone
+    a new snapshot instead (`snapshot()`, again at most once per
+    interval). A subscriber falling `backlog` sends behind is dropped,
+    and gets a new snapshot when it reconnects.
+    """
+
+    def __init__(self, fetch, snapshot, event='change', interval=0.5, heartbeat=15,
+                 backlog=256, watch=None):
+        self.fetch = fetch
+        self.snapshot = snapshot
+        self.event = event
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.backlog = backlog
+        self.watch = watch
+        self.events = 0
+        self.snapshots = 0
+        self.dropped = 0
+        self._subscribers = set()
+        self._changed = set()
+        self._resync = False
+        self._version = watch() if watch else None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def publish(self, key):
+        with self._lock:
+            self._changed.add(key)
+
+    def resync(self):
+        """Everything may have changed (e.g. after a reset)."""
+        with self._lock:
+            self._resync = True
+
+    def stream(self):
+        """A route's response: the snapshot, then the changes as they come."""
+        response.content_type = 'text/event-stream'
+        response.set_header('Cache-Control', 'no-cache')
+        subscriber = _Subscriber(self.backlog)
+        # Subscribe before taking the snapshot, so nothing falls in between
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            yield sse('snapshot', {"data": self.snapshot()})
+            while not subscriber.dropped:
+                try:
+                    yield subscriber.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    # Also how we find out the client has gone
+                    yield b": keep-alive\n\n"
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self._dispatch()
+            except Exception:
+                log.exception("could not send changes")
+
+    def _dispatch(self):
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            resync, self._resync = self._resync, False
+            subscribers = list(self._subscribers)
+        if self.watch is not None:
+            version = self.watch()
+            resync = resync or version != self._version
+            self._version = version
+        if not subscribers:
+            return
+        if resync:
+            self.snapshots += 1
+            data = sse('snapshot', {"data": self.snapshot()})
+        elif changed:
+            items = self.fetch(sorted(changed))
+            self.events += len(items)
+            data = b"".join(sse(self.event, item) for item in items)
+        else:
+            return
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(data)
+            except queue.Full:
+                subscriber.dropped = True
+                self.dropped += 1
+
+    def close(self):
+        """Stops the dispatching thread, and ends every subscriber's stream."""
+        self._closed.set()
+        self._thread.join()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.dropped = True
+            try:
+                # Wakes the stream, which then sees it's been dropped
+                subscriber.queue.put_nowait(b"")
+            except queue.Full:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subscribers), "events": self.events,
+                    "snapshots": self.snapshots, "dropped": self.dropped,
+                    "intervalMs": self.interval * 1000}
@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Queued by close(), after everything still to be committed
+_STOP = object()
+
+
+class GroupCommitQueue:
+    """
+    Runs `work(cursor, *args)` for submitted requests on one writer
+    thread, many to a transaction: the thread takes whatever is queued
+    (up to `batch_size`, waiting at most `max_wait` seconds for more),
+    runs each under its own savepoint and commits them all at once.
+    submit() blocks until the batch holding the request has committed,
+    and returns what `work` returned (or raises what it raised).
+    """
+
+    def __init__(self, pool, work, batch_size=64, max_wait=0.0):
+        self.pool = pool
+        self.work = work
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def submit(self, *args):
+        future = Future()
+        self._queue.put((args, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self._run_batch(batch)
+            if stop:
+                return
+
+    def _run_batch(self, batch):
+        try:
+            with self.pool.writer() as db:
+                results = self._commit(db, batch)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.requests += len(batch)
+        for (_, future), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _commit(self, db, batch):
+        c = db.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        results = []
+        for args, _ in batch:
+            c.execute("SAVEPOINT request")
+            try:
+                results.append((True, self.work(c, *args)))
+            except Exception as e:
+                # Only this request's changes go
+                c.execute("ROLLBACK TO request")
+                results.append((False, e))
+            c.execute("RELEASE request")
+        db.commit()
+        return results
+
+    def close(self):
+        """Commits whatever is queued, then stops the writer thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self):
+        return {"batches": self.batches, "requests": self.requests,
+                "queued": self._queue.qsize()}
@@ -0,0 +1,164 @@
+import logging
+import queue
+import sqlite3
+import threading
+from collections import Counter
+
+
+log = logging.getLogger('lab3.inventory')
+
+STRIPES = 64
+
+# Queued by close(), after the last tickets to write
+_STOP = object()
+
+
+class SeatInventory:
+    """
+    Remaining seats per screening, kept in memory so sales can be
+    admitted (or turned away) without touching the database. Sold
+    tickets are written behind, in batches of up to `batch_size`, by a
+    flusher thread; sales wait once `max_pending` tickets are queued.
+    On load, remaining_seats is first reconciled with the tickets that
+    actually made it to disk.
+    """
+
+    def __init__(self, pool, batch_size=512, max_pending=8192):
+        self.pool = pool
+        self.batch_size = batch_size
+        self._seats = {}
+        self._locks = [threading.Lock() for _ in range(STRIPES)]
+        self._pending = queue.Queue(maxsize=max_pending)
+        # Tickets queued and written (or dropped) so far, in order
+        self._queued = 0
+        self._written = 0
+        self._progress = threading.Condition()
+        self._order = threading.Lock()
+        self._flusher = threading.Thread(target=self._run, name='seat-inventory', daemon=True)
+        self._flusher.start()
+
+    def _lock(self, screening_id):
+        return self._locks[hash(screening_id) % STRIPES]
+
+    def load(self):
+        self.flush()
+        with self.pool.writer() as db:
+            db.execute(
+                """
+                UPDATE screenings
+                SET    remaining_seats = (SELECT capacity
+                                          FROM   theaters
+                                          WHERE  theater_name = screenings.theater_name)
+                                       - (SELECT count()
+                                          FROM   tickets
+                                          WHERE  screening_id = screenings.screening_id)
+                """)
+            db.commit()
+            seats = dict(db.execute(
+                """
+                SELECT screening_id, remaining_seats
+                FROM   screenings
+                """))
+        self._seats = seats
+
+    def add(self, screening_id, seats):
+        with self._lock(screening_id):
+            self._seats[screening_id] = seats
+
+    def remaining(self, screening_id):
+        return self._seats.get(screening_id)
+
+    def take(self, screening_id):
+        """True if we got a seat, False if sold out, None if there's no such screening."""
+        with self._lock(screening_id):
+            seats = self._seats.get(screening_id)
+            if seats is None:
+                return None
+            if seats <= 0:
+                return False
+            self._seats[screening_id] = seats - 1
+            return True
+
+    def write_behind(self, ticket_id, user_name, screening_id):
+        # Counted in queue order, for flush(). A full queue only holds
+        # up other sales, not the flusher
+        with self._order:
+            self._pending.put((ticket_id, user_name, screening_id))
+            with self._progress:
+                self._queued += 1
+
+    def flush(self):
+        """Waits until every ticket sold so far is on disk (not those sold meanwhile)."""
+        with self._progress:
+            last = self._queued
+            self._progress.wait_for(lambda: self._written >= last)
+
+    def _run(self):
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            tickets = batch[:-1] if stop else batch
+            try:
+                if tickets:
+                    self._write(tickets)
+            except Exception:
+                log.exception("could not write %d tickets", len(tickets))
+            finally:
+                with self._progress:
+                    self._written += len(tickets)
+                    self._progress.notify_all()
+            if stop:
+                return
+
+    def close(self):
+        """Writes the tickets sold so far, then stops the flusher thread."""
+        self._pending.put(_STOP)
+        self._flusher.join()
+
+    def _write(self, batch):
+        with self.pool.writer() as db:
+            c = db.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SAVEPOINT batch")
+            try:
+                c.executemany(
+                    """
+                    INSERT
+                    INTO   tickets(ticket_id, user_name, screening_id)
+                    VALUES (?, ?, ?)
+                    """, batch)
+                written = batch
+            except sqlite3.IntegrityError:
+                # Someone in the batch can't be written (their screening
+                # or user is gone, e.g. after a reset), so undo the rows
+                # before them and go one by one
+                c.execute("ROLLBACK TO batch")
+                written = []
+                for ticket in batch:
+                    c.execute("SAVEPOINT ticket")
+                    try:
+                        c.execute(
+                            """
+                            INSERT
+                            INTO   tickets(ticket_id, user_name, screening_id)
+                            VALUES (?, ?, ?)
+                            """, ticket)
+                        written.append(ticket)
+                    except sqlite3.IntegrityError:
+                        c.execute("ROLLBACK TO ticket")
+                        log.warning("dropped ticket %s for screening %s", ticket[0], ticket[2])
+                    c.execute("RELEASE ticket")
+            c.execute("RELEASE batch")
+            sold = Counter(screening_id for _, _, screening_id in written)
+            c.executemany(
+                """
+                UPDATE screenings
+                SET    remaining_seats = remaining_seats - ?
+                WHERE  screening_id = ?
+                """, [(count, screening_id) for screening_id, count in sold.items()])
+            db.commit()
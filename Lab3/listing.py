@@ -0,0 +1,58 @@
+from itertools import islice
+
+from bottle import HTTPResponse, request, response
+
+import serializer
+
+
+MAX_LIMIT = 1000
+
+
+def page_params():
+    """
+    Reads the keyset pagination parameters: `limit` (at most MAX_LIMIT
+    rows, None when not given) and `after` (the key of the last row of
+    the previous page, None when not given).
+    """
+    limit = None
+    if request.query.limit:
+        try:
+            limit = int(request.query.limit)
+        except ValueError:
+            raise HTTPResponse("limit must be an integer", status=400)
+        if not 0 < limit <= MAX_LIMIT:
+            raise HTTPResponse(f"limit must be between 1 and {MAX_LIMIT}", status=400)
+    return limit, request.query.after or None
+
+
+def sql_limit(limit):
+    """The value for a `LIMIT ?`: one extra row tells us there's a next page."""
+    return -1 if limit is None else limit + 1
+
+
+def listing(rows, limit, key, to_item=None):
+    """
+    Turns the rows of a cursor into a response: {"data": [...]} (with a
+    "next" cursor, `key` of the last row, when `limit` cut the result
+    short), or, with ?format=ndjson, one JSON object per line, streamed
+    straight from the cursor without building the list.
+
+    The rows are expected to be the items already (the cursor's
+    row_factory builds them), unless a `to_item` is given to map them.
+    """
+    if request.query.format == 'ndjson':
+        response.content_type = 'application/x-ndjson'
+        if to_item is not None:
+            rows = map(to_item, rows)
+        dumps = serializer.dumps
+        return (dumps(item) + b"\n" for item in islice(rows, limit))
+
+    if limit is None:
+        return {"data": rows.fetchall() if to_item is None else list(map(to_item, rows))}
+    page = rows.fetchmany(limit + 1)
+    next_key = key(page[limit - 1]) if len(page) > limit else None
+    del page[limit:]
+    found = {"data": page if to_item is None else list(map(to_item, page))}
+    if next_key is not None:
+        found["next"] = next_key
+    return found
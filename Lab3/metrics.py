@@ -0,0 +1,187 @@
+import logging
+import sqlite3
+import threading
+import types
+from time import perf_counter
+
+
+log = logging.getLogger('lab3.sql')
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+# Statements we keep separate histograms for, the rest go under "other"
+MAX_STATEMENTS = 500
+
+_current = threading.local()
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+
+    def observe(self, ms, rows=0):
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += ms
+        self.rows += rows
+
+    def to_dict(self, with_rows=False):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+        found = {"count": self.count, "sumMs": round(self.total, 3), "buckets": buckets}
+        if with_rows:
+            found["rows"] = self.rows
+        return found
+
+
+class Metrics:
+    """Wall time per route, and time and rows per SQL statement."""
+
+    def __init__(self, slow_ms=100):
+        self.slow_ms = slow_ms
+        self.routes = {}
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def observe_route(self, route, ms):
+        with self._lock:
+            self.routes.setdefault(route, Histogram()).observe(ms)
+
+    def observe_statement(self, sql, ms, rows):
+        sql = " ".join(sql.split())
+        if ms >= self.slow_ms:
+            log.warning("slow query (%.1f ms, %d rows): %s", ms, rows, sql)
+        with self._lock:
+            if sql not in self.statements and len(self.statements) >= MAX_STATEMENTS:
+                sql = "other"
+            self.statements.setdefault(sql, Histogram()).observe(ms, rows)
+
+    def to_dict(self):
+        with self._lock:
+            return {"routes": {route: h.to_dict() for route, h in self.routes.items()},
+                    "sql": {sql: h.to_dict(with_rows=True) for sql, h in self.statements.items()},
+                    "slowQueryMs": self.slow_ms}
+
+
+class _Statement:
+    __slots__ = ('sql', 'seconds', 'rows')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.seconds = 0.0
+        self.rows = 0
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Times everything done with the cursor (executing and fetching) and
+    counts the rows it returns, for the request being handled.
+    """
+
+    _statement = None
+
+    def _start(self, sql):
+        statements = getattr(_current, 'statements', None)
+        self._statement = None
+        if statements is not None:
+            self._statement = _Statement(sql)
+            statements.append(self._statement)
+
+    def _timed(self, method, *args, rows=None):
+        statement = self._statement
+        if statement is None:
+            return method(*args)
+        start = perf_counter()
+        try:
+            result = method(*args)
+        finally:
+            statement.seconds += perf_counter() - start
+        if rows is not None:
+            statement.rows += rows(result)
+        return result
+
+    def execute(self, sql, parameters=()):
+        self._start(sql)
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        return self._timed(super().fetchone, rows=lambda row: row is not None)
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        return self._timed(super().fetchmany, size, rows=len)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, rows=len)
+
+    def __next__(self):
+        return self._timed(super().__next__, rows=lambda row: 1)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+class MetricsPlugin:
+    """
+    Bottle plugin recording the wall time of every route, and of each
+    SQL statement run on an InstrumentedConnection while handling it.
+    Install it first (Bottle makes the first plugin installed the
+    outermost), so it also times the other plugins (e.g. cache hits).
+    """
+
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def apply(self, callback, route):
+        metrics = self.metrics
+        name = f"{route.method} {route.rule}"
+
+        def finish(start, statements):
+            _current.statements = None
+            metrics.observe_route(name, (perf_counter() - start) * 1000)
+            for statement in statements:
+                metrics.observe_statement(statement.sql, statement.seconds * 1000, statement.rows)
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            statements = _current.statements = []
+            try:
+                result = callback(*args, **kwargs)
+            except BaseException:
+                finish(start, statements)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _finish_after(result, finish, start, statements)
+            finish(start, statements)
+            return result
+
+        return wrapper
+
+
+def _finish_after(rows, finish, start, statements):
+    # The cursors being streamed already hold on to their statements
+    try:
+        yield from rows
+    finally:
+        finish(start, statements)
@@ -0,0 +1,105 @@
+CREATE TABLE IF NOT EXISTS theaters(
+  theater_name     TEXT,
+  capacity         INT,
+  PRIMARY KEY  (theater_name)
+);
+
+CREATE TABLE IF NOT EXISTS movies (
+  imdb_key          TEXT,
+  movie_title       TEXT,
+  production_year   INT,
+  running_time      INT,
+  PRIMARY KEY  (imdb_key)
+);
+
+CREATE TABLE IF NOT EXISTS customers (
+  user_name         TEXT,
+  full_name         TEXT,
+  password          TEXT,
+  PRIMARY KEY  (user_name)
+);
+
+CREATE TABLE IF NOT EXISTS screenings (
+  screening_id       TEXT DEFAULT (lower(hex(randomblob(16)))),
+  start_time            TIME,
+  start_date            DATE,
+  theater_name  TEXT,
+  imdb_key        TEXT,
+  remaining_seats INT,
+  PRIMARY KEY   (screening_id),
+  FOREIGN KEY   (theater_name) REFERENCES theaters(theater_name),
+  FOREIGN KEY   (imdb_key) REFERENCES movies(imdb_key)
+);
+
+CREATE TABLE IF NOT EXISTS tickets (
+  ticket_id             TEXT DEFAULT (lower(hex(randomblob(16)))),
+  user_name   TEXT,
+  screening_id     TEXT NOT NULL,
+  PRIMARY KEY  (ticket_id),
+  FOREIGN KEY (screening_id) REFERENCES screenings(screening_id),
+  FOREIGN KEY  (user_name) REFERENCES customers(user_name)
+);
+
+-- Secondary indexes for the ticket and screening lookups, tickets by
+-- user also covers the group by screening in GET /users/<u>/tickets
+CREATE INDEX IF NOT EXISTS tickets_by_user
+  ON tickets(user_name, screening_id);
+
+CREATE INDEX IF NOT EXISTS tickets_by_screening
+  ON tickets(screening_id);
+
+CREATE INDEX IF NOT EXISTS screenings_by_movie
+  ON screenings(imdb_key);
+
+CREATE INDEX IF NOT EXISTS screenings_by_theater
+  ON screenings(theater_name);
+
+-- Movie search (GET /movies?title=...&titlePrefix=...&year=...),
+-- titles are matched without regard to case
+CREATE INDEX IF NOT EXISTS movies_by_title
+  ON movies(movie_title COLLATE NOCASE, production_year);
+
+CREATE INDEX IF NOT EXISTS movies_by_year
+  ON movies(production_year);
+
+-- Tickets per user and screening, kept up to date by the triggers
+-- below, so GET /users/<username>/tickets is one range read
+CREATE TABLE IF NOT EXISTS user_tickets (
+  user_name         TEXT NOT NULL,
+  screening_id      TEXT NOT NULL,
+  nbr_of_tickets    INT NOT NULL,
+  PRIMARY KEY  (user_name, screening_id),
+  FOREIGN KEY  (user_name) REFERENCES customers(user_name),
+  FOREIGN KEY  (screening_id) REFERENCES screenings(screening_id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS user_tickets_on_insert
+AFTER INSERT ON tickets
+WHEN NEW.user_name IS NOT NULL
+BEGIN
+  INSERT
+  INTO   user_tickets(user_name, screening_id, nbr_of_tickets)
+  VALUES (NEW.user_name, NEW.screening_id, 1)
+  ON CONFLICT (user_name, screening_id)
+  DO UPDATE SET nbr_of_tickets = nbr_of_tickets + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_tickets_on_delete
+AFTER DELETE ON tickets
+WHEN OLD.user_name IS NOT NULL
+BEGIN
+  UPDATE user_tickets
+  SET    nbr_of_tickets = nbr_of_tickets - 1
+  WHERE  user_name = OLD.user_name AND screening_id = OLD.screening_id;
+  DELETE
+  FROM   user_tickets
+  WHERE  user_name = OLD.user_name AND screening_id = OLD.screening_id AND nbr_of_tickets <= 0;
+END;
+
+-- Databases with tickets from before the summary existed
+INSERT
+INTO   user_tickets(user_name, screening_id, nbr_of_tickets)
+SELECT user_name, screening_id, count()
+FROM   tickets
+WHERE  user_name IS NOT NULL AND NOT EXISTS (SELECT 1 FROM user_tickets)
+GROUP BY user_name, screening_id;
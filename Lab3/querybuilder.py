@@ -0,0 +1,59 @@
+from functools import lru_cache
+
+
+class QueryBuilder:
+    """
+    Composes a SELECT from a fixed base statement, named WHERE
+    conditions and named orderings. Conditions always come in the
+    order they were declared, and IN lists are padded to a power of
+    two, so each combination of filters gives one statement text,
+    which SQLite's statement cache (cached_statements) can reuse.
+    """
+
+    def __init__(self, select, filters, orderings):
+        self.select = select.rstrip()
+        self.filters = filters
+        self.orderings = orderings
+        self.sql = lru_cache(maxsize=256)(self._sql)
+
+    def _sql(self, names, sizes, order):
+        conditions = []
+        for name, size in zip(names, sizes):
+            condition = self.filters[name]
+            if size is not None:
+                condition = condition.format(", ".join(["?"] * size))
+            conditions.append(condition)
+        where = " AND ".join(conditions) or "TRUE"
+        return f"""{self.select}
+        WHERE    {where}
+        ORDER BY {self.orderings[order]}
+        LIMIT    ?
+        """
+
+    def build(self, values, order, limit=-1):
+        """
+        Returns the statement and its parameters for the filters in
+        `values` (lists and tuples go to IN conditions).
+        """
+        names, sizes, params = [], [], []
+        for name in self.filters:
+            if name not in values:
+                continue
+            value = values[name]
+            if isinstance(value, (list, tuple)):
+                value = _pad(list(value))
+                sizes.append(len(value))
+                params.extend(value)
+            else:
+                sizes.append(None)
+                params.append(value)
+            names.append(name)
+        return self.sql(tuple(names), tuple(sizes), order), params + [limit]
+
+
+def _pad(values):
+    # Repeating a value doesn't change what IN matches
+    size = 1
+    while size < len(values):
+        size *= 2
+    return values + values[-1:] * (size - len(values))
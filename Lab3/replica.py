@@ -0,0 +1,194 @@
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+log = logging.getLogger('lab3.replica')
+
+_names = itertools.count(1)
+
+
+class _Copy:
+    """One copy of the database, and the idle connections to it."""
+
+    def __init__(self, uri, keeper):
+        self.uri = uri
+        # An in-memory database lasts as long as a connection to it
+        self.keeper = keeper
+        self.idle = []
+
+
+class Replica:
+    """
+    An in-memory copy of the pool's database for read routes, so they
+    don't compete with writers for the file. A thread copies the
+    database over with SQLite's backup API whenever it has changed:
+    checking every `interval` seconds, and with `on_write` also as soon
+    as the pool's writer has been used. Each copy is a new shared-cache
+    in-memory database which is swapped in whole, so readers never see
+    one half made.
+
+    The copy's lag is how long it has been missing a write we know of
+    (one made through `pool`, or with `watch`, a callable returning a
+    version other processes bump too, by them), 0 while it's up to
+    date. reader(max_age) hands out a connection to the copy if it
+    lags at most `max_age` seconds, and a pool reader otherwise.
+    `budgets` maps the names routes give in their `replica` config to
+    their max_age.
+    """
+
+    def __init__(self, pool, budgets, interval=0.25, on_write=True, watch=None):
+        self.pool = pool
+        self.budgets = budgets
+        self.interval = interval
+        self.on_write = on_write
+        self.watch = watch
+        self.refreshes = 0
+        self.reads = 0
+        self.fallbacks = 0
+        self.refresh_ms = 0.0
+        self._copy = None
+        self._source = None
+        self._version = None
+        self._synced = None
+        self._writes = 0
+        self._lagging_since = None
+        self._watched = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        pool.on_write.append(self.written)
+        self._thread = threading.Thread(target=self._run, name='replica', daemon=True)
+        self._thread.start()
+
+    def written(self):
+        """A write was made, so the copy (probably) lags."""
+        with self._lock:
+            self._writes += 1
+            if self._lagging_since is None:
+                self._lagging_since = time.monotonic()
+        if self.on_write:
+            self._wake.set()
+
+    def lag(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.watch is not None and self._lagging_since is None and self.watch() != self._watched:
+                self._lagging_since = now
+                if self.on_write:
+                    self._wake.set()
+            return 0.0 if self._lagging_since is None else now - self._lagging_since
+
+    def age(self):
+        """Seconds since the copy was last known to match the database."""
+        synced = self._synced
+        return None if synced is None else time.monotonic() - synced
+
+    @contextmanager
+    def reader(self, max_age=0.0):
+        """Yields a connection and how many seconds it lags (None for the database itself)."""
+        lag = self.lag()
+        with self._lock:
+            copy = self._copy
+            if copy is not None and lag <= max_age:
+                conn = copy.idle.pop() if copy.idle else self._connect(copy.uri)
+                self.reads += 1
+            else:
+                if copy is None:
+                    self._wake.set()
+                copy = None
+                self.fallbacks += 1
+        if copy is None:
+            with self.pool.reader() as conn:
+                yield conn, None
+            return
+        try:
+            yield conn, lag
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                current = copy is self._copy
+                if current:
+                    copy.idle.append(conn)
+            if not current:
+                conn.close()
+
+    def _connect(self, uri):
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                               cached_statements=self.pool.cached_statements,
+                               factory=self.pool.factory)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def refresh(self):
+        """Makes a new copy, if the database has changed since the last one."""
+        if self._source is None:
+            uri = Path(self.pool.path).absolute().as_uri() + "?mode=ro"
+            self._source = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        with self._lock:
+            writes = self._writes
+            watched = self.watch() if self.watch is not None else None
+        checked = time.monotonic()
+        # Changes whenever another connection has committed
+        version, = self._source.execute("PRAGMA data_version").fetchone()
+        if version != self._version or self._copy is None:
+            self._swap(self._copy_database())
+            self.refreshes += 1
+            self.refresh_ms = (time.monotonic() - checked) * 1000
+        with self._lock:
+            self._version = version
+            self._synced = checked
+            self._watched = watched
+            # Writes made since we checked are still missing
+            if self._writes == writes:
+                self._lagging_since = None
+
+    def _copy_database(self):
+        uri = f"file:replica-{next(_names)}?mode=memory&cache=shared"
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        # An in-memory destination can't change its page size mid-backup
+        page_size, = self._source.execute("PRAGMA page_size").fetchone()
+        keeper.execute(f"PRAGMA page_size = {int(page_size)}")
+        self._source.backup(keeper)
+        return _Copy(uri, keeper)
+
+    def _swap(self, copy):
+        with self._lock:
+            old, self._copy = self._copy, copy
+        # Connections still in use are closed when they come back
+        if old is not None:
+            for conn in old.idle + [old.keeper]:
+                conn.close()
+
+    def _run(self):
+        while True:
+            # The first copy is made once it's wanted
+            self._wake.wait(self.interval if self._copy is not None else None)
+            self._wake.clear()
+            if self._closed:
+                break
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("could not refresh the replica")
+
+    def close(self):
+        self.pool.on_write.remove(self.written)
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self._swap(None)
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def stats(self):
+        age = self.age()
+        return {"refreshes": self.refreshes, "reads": self.reads, "fallbacks": self.fallbacks,
+                "ageMs": None if age is None else age * 1000, "lagMs": self.lag() * 1000,
+                "refreshMs": self.refresh_ms, "intervalMs": self.interval * 1000}
@@ -0,0 +1,6 @@
+-- What POST /reset leaves behind: just our theaters
+INSERT
+INTO   theaters(theater_name, capacity)
+VALUES ('Kino', 10),
+       ('Regal', 16),
+       ('Skandia', 100);
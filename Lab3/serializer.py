@@ -0,0 +1,35 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# Each takes a dict (or list) and returns UTF-8 encoded JSON
+ENCODERS = {'json': _stdlib_dumps}
+if orjson is not None:
+    ENCODERS['orjson'] = orjson.dumps
+
+# What the response cache, NDJSON listings and the JSON plugin use,
+# set with use()
+dumps = _stdlib_dumps
+
+
+def use(name='auto'):
+    """
+    Picks the JSON encoder for responses: 'orjson' (~10x faster on big
+    listings), 'json' (the stdlib), or 'auto' for orjson if it's
+    installed. Returns it, for Bottle's JSONPlugin.
+    """
+    global dumps
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in ENCODERS:
+        raise ValueError(f"no JSON encoder named {name}, try one of {', '.join(ENCODERS)}")
+    dumps = ENCODERS[name]
+    return dumps
@@ -0,0 +1,211 @@
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from bottle import ServerAdapter, run
+
+from aioserver import AsyncioServer
+
+
+log = logging.getLogger('lab3.servers')
+
+# Set for prefork workers, to the listening socket they inherited
+LISTEN_FD = 'LAB3_LISTEN_FD'
+
+
+class _PooledWSGIServer(WSGIServer):
+    """
+    wsgiref server handing each connection to a fixed thread pool.
+    Requests for one of the `streams` paths (long-lived responses, like
+    server-sent events) get a thread of their own instead, so they
+    don't starve the pool.
+    """
+
+    # socketserver's default backlog of 5 drops connections under load
+    request_queue_size = 128
+
+    def __init__(self, address, handler, threads, fd=None, streams=()):
+        super().__init__(address, handler, bind_and_activate=fd is None)
+        if fd is not None:
+            # Already bound and listening, by the prefork supervisor
+            self.socket.close()
+            self.socket = socket.socket(fileno=fd)
+            host, port = self.socket.getsockname()[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+            self.setup_environ()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.streams = tuple(f"GET {path}".encode() for path in streams)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._dispatch, request, client_address)
+
+    def _dispatch(self, request, client_address):
+        if self.streams and self._is_stream(request):
+            threading.Thread(target=self._process, args=(request, client_address), daemon=True).start()
+        else:
+            self._process(request, client_address)
+
+    def _is_stream(self, request):
+        try:
+            head = request.recv(1024, socket.MSG_PEEK)
+        except OSError:
+            return False
+        target = head.split(b' HTTP/', 1)[0]
+        return any(target == path or target.startswith(path + b'?') for path in self.streams)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class ThreadPoolServer(ServerAdapter):
+    """
+    Bottle's default wsgiref server, but serving requests on a bounded
+    thread pool instead of one at a time.
+    """
+
+    def run(self, app):
+        threads = self.options.get('threads', 8)
+        quiet = self.quiet
+
+        class Handler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    return WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+        fd = self.options.get('fd')
+        srv = _PooledWSGIServer((self.host, self.port), Handler, threads, fd,
+                                self.options.get('streams', ()))
+        srv.set_app(app)
+        if fd is not None:
+            # A prefork worker: on SIGTERM stop accepting, and let the
+            # requests we have finish (shutdown() can't be called from
+            # the thread running serve_forever())
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: threading.Thread(target=srv.shutdown).start())
+        try:
+            srv.serve_forever()
+            srv.executor.shutdown(wait=True)
+        finally:
+            srv.server_close()
+
+
+class Supervisor:
+    """
+    Prefork mode: binds the listening socket, then runs `workers`
+    copies of this very program, each serving on the inherited socket
+    with its own connections. A worker that dies is restarted. SIGHUP
+    replaces them all, new ones first, so there's always someone to
+    accept. SIGTERM (or Ctrl-C) stops them, letting in-flight requests
+    finish.
+    """
+
+    def __init__(self, host, port, workers, stop_timeout=10):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.stop_timeout = stop_timeout
+        self.socket = None
+        self._reload = False
+        self._stopping = False
+
+    def _spawn(self):
+        fd = self.socket.fileno()
+        child = subprocess.Popen([sys.executable] + sys.argv, pass_fds=[fd],
+                                 env={**os.environ, LISTEN_FD: str(fd)})
+        return child, time.monotonic()
+
+    def _stop(self, children):
+        for child, _ in children:
+            if child.poll() is None:
+                child.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for child, _ in children:
+            try:
+                child.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                log.warning("worker %d didn't stop in time, killing it", child.pid)
+                child.kill()
+                child.wait()
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stopping = True
+
+    def run(self):
+        self.socket = socket.create_server((self.host, self.port), backlog=128)
+        signal.signal(signal.SIGHUP, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        print(f"Prefork supervisor {os.getpid()} listening on http://{self.host}:{self.port}/ "
+              f"with {self.workers} workers", file=sys.stderr)
+        children = [self._spawn() for _ in range(self.workers)]
+        try:
+            while not self._stopping:
+                if self._reload:
+                    self._reload = False
+                    old, children = children, [self._spawn() for _ in range(self.workers)]
+                    self._stop(old)
+                for i, (child, started) in enumerate(children):
+                    if child.poll() is None:
+                        continue
+                    log.warning("worker %d exited with %d, restarting it", child.pid, child.returncode)
+                    # Don't spin on a worker that can't even start
+                    if time.monotonic() - started < 1:
+                        time.sleep(1)
+                    children[i] = self._spawn()
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop(children)
+            self.socket.close()
+
+
+def is_worker():
+    return LISTEN_FD in os.environ
+
+
+def serve(app, host, port, server='threadpool', threads=8, workers=1, streams=(), **options):
+    """
+    Runs the Bottle `app` on `server`, which is 'threadpool',
+    'asyncio' (for many idle keep-alive clients), or the name of any
+    server adapter Bottle knows about (e.g. 'waitress', 'cheroot',
+    'wsgiref'). With more than one worker, this process becomes their
+    Supervisor instead (threadpool only), and `app` can be None, since
+    only the workers serve it. `streams` are the paths of long-lived
+    responses, which our own servers keep off their pools.
+    """
+    if workers > 1 and server != 'threadpool':
+        raise ValueError(f"prefork workers need the threadpool server, not {server}")
+    if is_worker():
+        options['fd'] = int(os.environ[LISTEN_FD])
+    elif workers > 1:
+        Supervisor(host, port, workers).run()
+        return
+    if server == 'threadpool':
+        server = ThreadPoolServer
+    elif server == 'asyncio':
+        server = AsyncioServer
+    if server in (ThreadPoolServer, AsyncioServer, 'waitress'):
+        options['threads'] = threads
+    if server in (ThreadPoolServer, AsyncioServer):
+        options['streams'] = streams
+    run(app, host=host, port=port, server=server, **options)